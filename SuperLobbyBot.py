@@ -2,8 +2,6 @@ import os
 import random
 import secrets
 import asyncio
-import json
-import math
 
 from datetime import datetime
 import time
@@ -12,154 +10,413 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 
-from lobby import Lobby, PermanentLobby
+from lobby import Lobby, PermanentLobby, MODE_REACTIONS, MODE_BUTTONS
+from scheduler import DeadlineScheduler
+from storage import LobbyStore
+from fanout import fanOut, reportErrors
+from registry import LobbyRegistry
+from dispatcher import dispatcher
+import metrics
+import shards
+import profiles
+import interactions
+import admission
+import profiler
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN') # Bot token
 LOBBY_TIMEOUT = int(os.getenv('LOBBY_TIMEOUT')) # Inactivity timeout in seconds
+CLIENT_PROFILE = os.getenv('CLIENT_PROFILE', 'minimal') # discord.py intents and caches, 'minimal' or 'default', see profiles.py
+LOBBY_MODE = os.getenv('LOBBY_MODE', MODE_REACTIONS) # How members join new lobbies, 'reactions' or 'buttons'
+MAX_LOBBIES_PER_AUTHOR = int(os.getenv('MAX_LOBBIES_PER_AUTHOR', 10)) # Open lobbies a user can have created, 0 for no limit
+MAX_LOBBIES_PER_GUILD = int(os.getenv('MAX_LOBBIES_PER_GUILD', 50)) # Lobbies with a clone in one server, 0 for no limit
+MAX_CLONES_PER_LOBBY = int(os.getenv('MAX_CLONES_PER_LOBBY', 25)) # Messages of one lobby, the original included, 0 for no limit
+REHYDRATE_CONCURRENCY = int(os.getenv('REHYDRATE_CONCURRENCY', 8)) # Lobbies restored at once on startup
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 4)) # Lobbies reconciled at once after a reconnect
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1') # Address of the Prometheus metrics endpoint
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108)) # Port of the metrics endpoint, 0 to disable
+OTHER_MESSAGES_CACHE = 100000 # Message ids remembered as not belonging to any lobby
+OTHER_MESSAGES_MIN_AGE = 30 # Seconds before a message not found in the store is remembered as no lobby message
+CHANGED = 1 # Returned by mailbox operations that changed the lobby, rendered after the render delay
+CHANGED_NOW = 2 # Returned by mailbox operations whose change is rendered before they complete
+
+bot = shards.createBot(command_prefix='!', **profiles.clientOptions(CLIENT_PROFILE))
+
+registry = LobbyRegistry()
+Lobby.member_index = registry
+timers = DeadlineScheduler()
+store = LobbyStore()
+other_messages = set() # Messages that are not lobby messages, only used when sharded
+lobbies_loaded = False # Set once the lobbies have been restored after startup
+reconcile_task = None
+reconcile_again = False # Reconnected while reconciling, run again afterwards
+
+metrics.registerGauge('lobbies', lambda: len(registry.lobbies))
+metrics.registerGauge('lobby_clones', lambda: len(registry.lobby_messages))
+metrics.registerGauge('lobby_members', lambda: sum(len(lobby.members) for lobby in registry.lobbies.values()))
+metrics.registerGauge('lobby_mailbox_depth', lambda: [({'lobby': lobby.hash}, len(lobby.mailbox))
+    for lobby in registry.lobbies.values() if len(lobby.mailbox) > 0])
+
+async def start_metrics():
+    if METRICS_PORT == 0: return
+    await metrics.startServer(METRICS_HOST, METRICS_PORT)
+    print(f'Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+
+async def run_timers():
+    await bot.wait_until_ready()
+    await timers.run(check_lobby)
+
+def schedule_lobby(lobby):
+    timers.schedule(lobby.hash, lobby.nextDeadline(LOBBY_TIMEOUT))
+
+@metrics.timed('task_seconds', task='check_lobby')
+async def check_lobby(lobby_id):
+    if lobby_id not in registry.lobbies: return
+    await registry.lobbies[lobby_id].post(op_check_timeouts)
+
+@metrics.timed('task_seconds', task='run_lobby')
+async def run_lobby(lobby, batch):
+    # Worker of every lobby's mailbox. Applies a batch of operations in
+    # order, then renders, saves and reschedules the lobby once. A lobby is
+    # finalized as soon as an operation fills it, the rest of the batch
+    # applies to the reset permanent lobby or finds the lobby finalized.
+    metrics.increment('mailbox_batches_total')
+    metrics.increment('mailbox_ops_total', len(batch))
+    change = 0
+    results = []
+    try:
+        for op, args, future in batch:
+            try:
+                result = await op(lobby, *args)
+                results.append((future, result, None))
+                change = max(change, result or 0)
+            except Exception as e: results.append((future, None, e))
+            if change > 0 and not lobby.finalized and lobby.isFull():
+                await fill_lobby(lobby)
+                change = 0
+
+        if change > 0 and not lobby.finalized and lobby.hash in registry.lobbies:
+            if change == CHANGED_NOW:
+                lobby.cancelUpdate()
+                await lobby.updateMessages()
+            else: lobby.scheduleUpdate()
+            schedule_lobby(lobby)
+            store.markDirty(lobby)
+    finally:
+        for future, result, error in results:
+            if future.done(): continue
+            if error != None: future.set_exception(error)
+            else: future.set_result(result)
+
+Lobby.mailbox_handler = run_lobby
+
+async def fill_lobby(lobby):
+    await lobby.finalizeLobby()
+    if type(lobby) is Lobby:
+        removeLobby(lobby.hash)
+    else:
+        schedule_lobby(lobby)
+        store.markDirty(lobby)
+
+# Mailbox operations, run by the lobby's worker as op(lobby, *args). They
+# return CHANGED or CHANGED_NOW if the lobby changed.
+
+async def op_check_timeouts(lobby):
+    if lobby.finalized: return
+    reason = None
+    change = None
+    current_time = time.time()
+    try:
+        # Regular lobby timeout
+        if lobby.isTimedOut():
+            reason = 'Timed out.'
 
-bot = commands.Bot(command_prefix='!')
-
-lobbies = {}
-lobby_messages = {}
-lobby_authors = {}
-
-lobby_lock = asyncio.Lock()
+        # Inactivity timeout
+        elif current_time - lobby.last_activity > LOBBY_TIMEOUT:
+            reason = 'Inactivity timeout.'
 
-async def chron_checkup():
-    await bot.wait_until_ready()
-    
-    batch_size = 5 # Lobbies checked each iteration
-    update_interval = 60*5 # Interval in which all lobbies should be checked
-    
-    offset_count = 0
-    while not bot.is_closed():
-        await lobby_lock.acquire()
+        else:
+            # Check for user timeouts
+            if await lobby.updateMemberTimeouts():
+                change = CHANGED
+    except: pass
 
-        offset_count += batch_size
-        if offset_count >= len(lobbies):
-            offset_count = 0
-        if len(lobbies) < batch_size: sleep_time = 30
-        else: sleep_time = math.ceil(batch_size / len(lobbies)) * update_interval
+    if reason == None:
+        schedule_lobby(lobby)
+        return change
+    await lobby.finalizeLobby(False, reason)
+    if lobby.hash in registry.lobbies: removeLobby(lobby.hash)
 
-        keys = list(lobbies.keys())[offset_count:offset_count+batch_size]
+async def op_reconcile(lobby):
+    if lobby.finalized: return
+    message_ids = list(lobby.messages)
+    # Reconcile reactions added or removed while the bot was offline.
+    await lobby.updateLobby()
 
-        lobbies_to_remove = []
-        current_time = time.time()
+    for message_id in message_ids:
+        if message_id not in lobby.messages: registry.removeMessage(message_id)
+    if len(lobby.messages) == 0:
+        await lobby.finalizeLobby(False, 'Messages removed.')
+        removeLobby(lobby.hash)
+        return
+    return CHANGED
+
+# Reactions on lobbies in button mode are not lobby membership.
+
+async def op_reaction_add(lobby, message_id, user_id, emoji):
+    if lobby.finalized or lobby.mode != MODE_REACTIONS: return
+    if not lobby.addReaction(message_id, user_id, emoji): return
+    return CHANGED
+
+async def op_reaction_remove(lobby, message_id, user_id, emoji):
+    if lobby.finalized or lobby.mode != MODE_REACTIONS: return
+    if not lobby.removeReaction(message_id, user_id, emoji): return
+    return CHANGED
+
+async def op_reaction_clear(lobby, message_id, emoji):
+    if lobby.finalized or lobby.mode != MODE_REACTIONS: return
+    if not lobby.clearMessageReactions(message_id, emoji): return
+    return CHANGED
+
+async def op_interaction(lobby, interaction):
+    # Only applies the press, interaction_press answers it so the worker
+    # does not wait for the response.
+    if lobby.finalized or interaction.message_id not in lobby.messages:
+        interaction.outcome = 'closed'
+        return
+    if interaction.custom_id == interactions.JOIN_ID: changed = lobby.joinMember(interaction.message_id, interaction.user_id)
+    else: changed = lobby.leaveMember(interaction.user_id)
+    interaction.outcome = 'changed' if changed else 'unchanged'
+    if changed: return CHANGED
+
+async def op_message_delete(lobby, message_id):
+    if lobby.finalized or not lobby.removeMessage(message_id): return
+    if len(lobby.messages) > 0: return CHANGED
+    # Messages removed
+    await lobby.finalizeLobby(False, 'Messages removed.')
+    if lobby.hash in registry.lobbies: removeLobby(lobby.hash)
+
+async def op_close(lobby, reason):
+    try: await lobby.finalizeLobby(False, reason)
+    except: pass
+    if lobby.hash in registry.lobbies: removeLobby(lobby.hash)
+
+async def op_allow_cloning(lobby, value):
+    assert not lobby.finalized, 'Lobby is closed.'
+    lobby.allow_cloning = value
+    return CHANGED
+
+async def op_edit(lobby, command, value):
+    assert not lobby.finalized, 'Lobby is closed.'
+    if command == 'size':
+        lobby.size = value
+    elif command == 'lobby_timeout':
+        lobby.timeout = value*60
+    elif command == 'user_timeout':
+        lobby.user_timeout = value*60
+    lobby.changed()
+    return CHANGED_NOW
+
+async def op_clone(lobby, ctx):
+    assert not lobby.finalized, 'Lobby is closed.'
+    message = await lobby.postMessage(ctx)
+    assert message != None, 'Could not post new message.'
+    registry.addMessage(lobby, message.id)
+    # Posted without mentions, the render adds them.
+    return CHANGED
+
+def removeLobby(lobby_hash):
+    lobby = registry.remove(lobby_hash)
+    assert lobby != None, 'Trying to remove non existant lobby'
+    print(f'Deleting lobby {lobby_hash}')
+    timers.cancel(lobby_hash)
+    store.markRemoved(lobby_hash)
 
-        for lobby_id in keys:
-            lobby = lobbies[lobby_id]
-            await lobby.update_lock.acquire()
-            try:
-                await lobby.updateMessages()
-                await lobby.fetchMessages()
-
-                # Regular lobby timeout
-                if (lobby.isTimedOut()):
-                    lobbies_to_remove.append([lobby_id, 'Timed out.'])
-                
-                # Inactivity timeout
-                elif current_time - lobby.last_activity > LOBBY_TIMEOUT:
-                    lobbies_to_remove.append([lobby_id, 'Inactivity timeout.'])
-
-                # Messages removed
-                elif len(lobby.messages) == 0:
-                    lobbies_to_remove.append([lobby_id, 'Messages removed.'])
-
-                # Check for user timeouts
-                await lobby.updateMemberTimeouts()
-            except: pass
-            finally: lobby.update_lock.release()
+async def loadLobbyDump():
+    start_time = time.time()
+    print("Loading lobbies...")
+    lobby_types = {'Lobby': Lobby, 'PermanentLobby': PermanentLobby}
+    store.importJson('lobbies.json')
+
+    # Rebuild the indexes straight from the save data so events are routed
+    # as soon as the bot connects.
+    loaded = {}
+    for lobby_data in store.loadAll(shards.localShards() if shards.enabled() else None):
+        try:
+            lobby = lobby_types[lobby_data['type']](0, '', 0, -1, -1, bot)
+            lobby.loadData(lobby_data)
+        except Exception as e:
+            print(f'Could not load lobby {lobby_data.get("hash")}: {e}')
+            continue
+        registry.add(lobby, lobby.messages)
+        loaded[lobby.hash] = lobby
+    metrics.setGauge('startup_index_seconds', time.time() - start_time)
+    print(f'Indexed {len(loaded)} lobbies.')
 
-        lobby_lock.release()
+    await bot.wait_until_ready()
+    _, errors = await fanOut(rehydrate_lobby, loaded, REHYDRATE_CONCURRENCY)
+    reportErrors('Rehydrate lobbies', errors, len(loaded))
+    global lobbies_loaded
+    lobbies_loaded = True
+    metrics.setGauge('startup_seconds', time.time() - start_time)
+    print(f'Lobbies loaded in {time.time() - start_time:.1f}s.')
+
+@metrics.timed('task_seconds', task='rehydrate_lobby')
+async def rehydrate_lobby(lobby):
+    lobby.resolveGuilds()
+    registry.updatePlaces(lobby)
+    await lobby.post(op_reconcile)
+
+# Reactions made while the gateway was disconnected are never received.
+# After every reconnect all lobbies are compared with their messages again
+# in the background, while events keep being handled.
 
-        # Clean up lobbies
-        for [lobby_id, reason] in lobbies_to_remove:
-            if lobby_id in lobbies:
-                await lobbies[lobby_id].finalizeLobby(False, reason)
-                await removeLobby(lobby_id)
-        await asyncio.sleep(sleep_time - (time.time() - current_time))
+@bot.event
+async def on_ready():
+    start_reconcile()
 
-async def removeLobby(lobby_hash):
-    await lobby_lock.acquire()
-    try:
-        assert lobby_hash in lobbies, 'Trying to remove non existant lobby'
-        print(f'Deleting lobby {lobby_hash}')
-        lobby = lobbies[lobby_hash]
-        for message_id in lobbies[lobby_hash].messages:
-            try:
-                del lobby_messages[message_id]
-            except: pass
-        lobby_authors[lobby.author_id].remove(lobby)
-        del lobbies[lobby_hash]
-    except: raise
-    finally: lobby_lock.release()
-    await saveLobbyDump()
+@bot.event
+async def on_resumed():
+    start_reconcile()
+
+def start_reconcile():
+    # Startup rehydration already reconciles every lobby.
+    global reconcile_task, reconcile_again
+    if not lobbies_loaded: return
+    if reconcile_task != None:
+        reconcile_again = True
+        return
+    reconcile_task = asyncio.ensure_future(reconcile_lobbies())
 
-async def saveLobbyDump():
-    await lobby_lock.acquire()
+async def reconcile_lobbies():
+    global reconcile_task, reconcile_again
     try:
-        print('Saving lobbies to file...')
-        with open('lobbies.json', 'w') as f:
-            data = {}
-            for lobby in lobbies.values():
-                await lobby.update_lock.acquire()
-                data[lobby.hash] = lobby.getSaveData()
-                lobby.update_lock.release()
-            json.dump(data, f, indent=2)
-        print('Lobbies saved.')
-    except: raise
-    finally: lobby_lock.release()
-
-async def loadLobbyDump():
-    await lobby_lock.acquire()
-    await bot.wait_until_ready()
-    print("Loading lobbies from file...")
-    lobby_types = {'Lobby': Lobby, 'PermanentLobby': PermanentLobby}
-    with open('lobbies.json', 'r') as f:
-        # Try to load all save lobbies
-        data = json.load(f)
-        for lobby_data in data.values():
-            try:
-                lobby = lobby_types[lobby_data['type']](0, '', 0, -1, -1, bot)
-                await lobby.update_lock.acquire()
-                await lobby.loadData(lobby_data)
-                await lobby.updateLobby()
-
-                lobbies[lobby_data['hash']] = lobby
-                for message_id in lobby.messages:
-                    lobby_messages[message_id] = lobby
-                if lobby.author_id not in lobby_authors: lobby_authors[lobby.author_id] = []
-                lobby_authors[lobby.author_id].append(lobby)
-            except: pass
-            finally: lobby.update_lock.release()
-            
-    print("Lobbies loaded.")
-    lobby_lock.release()
+        while True:
+            reconcile_again = False
+            start_time = time.time()
+            lobbies = registry.lobbies
+            remaining = len(lobbies)
+            metrics.setGauge('reconcile_lobbies_remaining', remaining)
+
+            async def reconcile(lobby):
+                nonlocal remaining
+                try:
+                    if lobby.hash in registry.lobbies: await lobby.post(op_reconcile)
+                finally:
+                    remaining -= 1
+                    metrics.setGauge('reconcile_lobbies_remaining', remaining)
+                    metrics.increment('reconciled_lobbies_total')
+
+            _, errors = await fanOut(reconcile, lobbies, RECONCILE_CONCURRENCY)
+            reportErrors('Reconcile lobbies', errors, len(lobbies))
+            print(f'Reconciled {len(lobbies)} lobbies in {time.time() - start_time:.1f}s.')
+            if not reconcile_again: break
+    finally: reconcile_task = None
 
 
 @bot.command()
 @commands.is_owner()
+@metrics.timed('command_seconds', command='shutdown')
 async def shutdown(context):
-    await saveLobbyDump()
-    await lobby_lock.acquire()
+    await store.flush()
     print("Shutting down.")
     exit()
 
+@bot.command(name='stats', help='Show bot statistics. Owner only.')
+@commands.is_owner()
+@metrics.timed('command_seconds', command='stats')
+async def stats(ctx):
+    def ms(value): return '-' if value == None else f'{value*1000:.0f}ms'
+    requests = {}
+    for (name, labels), value in metrics.counters.items():
+        if name == 'discord_requests_total':
+            op = dict(labels)['op']
+            requests[op] = requests.get(op, 0) + value
+    handlers = sorted(key for key in metrics.histograms if key[0] in ['command_seconds', 'event_seconds'])
+    lines = [
+        f'Lobbies: {len(registry.lobbies)}, clones: {len(registry.lobby_messages)}, '
+        f'members: {sum(len(lobby.members) for lobby in registry.lobbies.values())}',
+        f'Request queue: {dispatcher.depth}, wait p95: {ms(metrics.quantile("dispatch_wait_seconds", 0.95))}',
+        'Slowest channels: ' + ', '.join(f'{bucket} avg {ms(average)} max {ms(max_wait)}'
+            for bucket, _, average, max_wait in dispatcher.slowestBuckets(3)),
+        f'Mailboxes: {sum(len(lobby.mailbox) for lobby in registry.lobbies.values())} queued, '
+        f'deepest {max([len(lobby.mailbox) for lobby in registry.lobbies.values()], default=0)}, '
+        f'batch p95: {ms(metrics.quantile("task_seconds", 0.95, task="run_lobby"))}',
+        f'Persistence flush p95: {ms(metrics.quantile("persistence_flush_seconds", 0.95))}',
+        f'Event loop lag: {ms(admission.loop_lag)}, blocked {metrics.counters.get(metrics.key("loop_blocked_total", {}), 0)} times, '
+        f'shedding: {admission.overloaded() or "no"}',
+        f'Shards: {shards.localShards()} of {max(1, shards.SHARD_COUNT)}',
+        'Requests: ' + ', '.join(f'{op} {count}' for op, count in sorted(requests.items())),
+        ]
+    for name, labels in handlers:
+        lines.append(f'{dict(labels)[name.split("_")[0]]}: p50 {ms(metrics.quantile(name, 0.5, **dict(labels)))}, '
+            f'p95 {ms(metrics.quantile(name, 0.95, **dict(labels)))}, n={metrics.histograms[(name, labels)][2]}')
+    await ctx.send('```\n' + '\n'.join(lines)[:1900] + '\n```')
+
+@bot.command(name='profile', help=(
+    'Profile the bot for some seconds and write a stats file. Owner only.\n'
+    'Usage: "!profile {seconds}"\n'
+    'Lists the functions that held the event loop the longest. The stats file can be read with pstats or snakeviz.'))
+@commands.is_owner()
+@metrics.timed('command_seconds', command='profile')
+async def profile(ctx, seconds: float):
+    assert 0 < seconds <= profiler.MAX_PROFILE_SECONDS, f'Profile length must be between 0 and {profiler.MAX_PROFILE_SECONDS} seconds.'
+    assert not profiler.profiling(), 'A profile is already running.'
+    await ctx.send(f'Profiling for {seconds:g}s...')
+    path, summary = await profiler.profileLoop(seconds)
+    await ctx.send(f'Wrote `{path}`\n```\n{summary[:1800]}\n```')
+
+def lobby_line(lobby, guild_id=None):
+    channels = ' '.join(f'<#{channel_id}>' for channel_id in dict.fromkeys(lobby.messages.values())
+        if guild_id == None or lobby.channel_guilds.get(channel_id) == guild_id)
+    return f'`{lobby.hash}` {lobby.title}{lobby.name} {len(lobby.members)}/{lobby.size} {channels}'
+
+def lobby_list(sections):
+    # sections: [(title, lines)], cut to fit in one message.
+    text = '\n'.join(f'**{title}**\n' + ('\n'.join(lines) if len(lines) > 0 else '...') for title, lines in sections)
+    if len(text) > 1900: text = text[:1900].rsplit('\n', 1)[0] + '\n...'
+    return text
+
+@bot.command(name='lobbies', help=(
+    'List the lobbies in this channel and server.\n'
+    'Usage: "!lobbies"'
+))
+@metrics.timed('command_seconds', command='lobbies')
+async def list_lobbies(ctx):
+    channel_lobbies = registry.lobby_channels.get(ctx.channel.id, {})
+    guild_lobbies = registry.lobby_guilds.get(ctx.guild.id, {}) if ctx.guild != None else {}
+    sections = [('Lobbies in this channel:', [lobby_line(lobby) for lobby in channel_lobbies.values()])]
+    if ctx.guild != None:
+        sections.append(('Other lobbies in this server:', [lobby_line(lobby, ctx.guild.id)
+            for lobby_hash, lobby in guild_lobbies.items() if lobby_hash not in channel_lobbies]))
+    await ctx.send(lobby_list(sections))
+
+@bot.command(name='mylobbies', help=(
+    'List the lobbies you have joined or created.\n'
+    'Usage: "!mylobbies"'
+))
+@metrics.timed('command_seconds', command='mylobbies')
+async def list_my_lobbies(ctx):
+    joined = registry.member_lobbies.get(ctx.author.id, {})
+    created = registry.lobby_authors.get(ctx.author.id, {})
+    await ctx.send(lobby_list([
+        ('Joined:', [lobby_line(lobby) for lobby in joined.values()]),
+        ('Created:', [lobby_line(lobby) for lobby in created.values()]),
+        ]))
+
 @bot.command(name='closelobby', help=(
     'Closes and removes a lobby. Also closes all clones of the lobby.\n'
     'Usage: "!closelobby {identifier}"\n'
     '  identifier - the lobby id string'
 ))
+@metrics.timed('command_seconds', command='closelobby')
 async def close_lobby(ctx, lobby_id: str):
+    if await forward_command(ctx, 'closelobby', lobby_id): return
+    lobbies = registry.lobbies
     assert lobby_id in lobbies, 'Lobby does not exist.'
     lobby = lobbies[lobby_id]
     assert lobby.author_id == ctx.author.id, 'You are not the creator of the lobby.'
-    await lobby.update_lock.acquire()
-    try: await lobby.finalizeLobby(False, "Lobby closed by creator.")
-    except: pass
-    finally: lobby.update_lock.release()
-    await removeLobby(lobby_id)
+    await lobby.post(op_close, "Lobby closed by creator.")
     await ctx.message.add_reaction('✅')
 
 @bot.command(name='allowcloning', help=(
@@ -168,17 +425,15 @@ async def close_lobby(ctx, lobby_id: str):
     '  identifier - the lobby id string\n'
     '  boolean - true->allow clones, false->disallow clones.'
 ))
+@metrics.timed('command_seconds', command='allowcloning')
 async def allow_cloning(ctx, lobby_id: str, value: bool):
+    if await forward_command(ctx, 'allowcloning', lobby_id, value): return
+    lobbies = registry.lobbies
     assert lobby_id in lobbies, 'Lobby does not exist.'
     lobby = lobbies[lobby_id]
-    await lobby.update_lock.acquire()
-    try:
-        assert lobby.author_id == ctx.author.id, 'You are not the creator of this lobby.'
-        lobby.allow_cloning = value
-        await lobby.updateMessages()
-        await ctx.message.add_reaction('✅')
-    except: raise
-    finally: lobby.update_lock.release()
+    assert lobby.author_id == ctx.author.id, 'You are not the creator of this lobby.'
+    await lobby.post(op_allow_cloning, value)
+    await ctx.message.add_reaction('✅')
 
 @bot.command(name='editlobby', help=(
     'Edit the settings of an existing lobby\n'
@@ -186,26 +441,19 @@ async def allow_cloning(ctx, lobby_id: str, value: bool):
     '  lobby_id:string - The lobby ID. Is specified in lobby messages.\n'
     '  command:string - valid commands "size" "lobby_timeout" "user_timeout"'
     '  parameters:integer - command specific parameters.'))
+@metrics.timed('command_seconds', command='editlobby')
 async def edit_lobby(ctx, lobby_id:str, command: str, value: int):
-    await lobby_lock.acquire()
-    try:
-        assert lobby_id in lobbies, "Lobby with id does not exist."
-        lobby = lobbies[lobby_id]
-        assert lobby.author_id == ctx.author.id, "You are not the creator of the lobby."
-        assert command in ['size', 'lobby_timeout', 'user_timeout'], "Invalid edit command."
-
-        if command == 'size':
-            assert value > 0 and value <= 1000, 'Invalid lobby size'
-            lobby.size = value
-        elif command == 'lobby_timeout':
-            lobby.timeout = value*60
-        elif command == 'user_timeout':
-            lobby.user_timeout = value*60
-        
-        await lobby.updateMessages()
-        await ctx.message.add_reaction('✅')
-    except: raise
-    finally: lobby_lock.release()
+    if await forward_command(ctx, 'editlobby', lobby_id, command, value): return
+    lobbies = registry.lobbies
+    assert lobby_id in lobbies, "Lobby with id does not exist."
+    lobby = lobbies[lobby_id]
+    assert lobby.author_id == ctx.author.id, "You are not the creator of the lobby."
+    assert command in ['size', 'lobby_timeout', 'user_timeout'], "Invalid edit command."
+    if command == 'size':
+        assert value > 0 and value <= 1000, 'Invalid lobby size'
+
+    await lobby.post(op_edit, command, value)
+    await ctx.message.add_reaction('✅')
 
 @bot.command(name='lobby', help=(
     'Create a new lobby in the current channel\n'
@@ -213,8 +461,10 @@ async def edit_lobby(ctx, lobby_id:str, command: str, value: int):
     '  size:integer - Size of lobby. Once reached all members are notifierd.\n'
     '  lobby_timeout:integer - Timeout time for lobby. After {timeout} minutes the lobby is closed. If set to -1 lobby never times out.\n'
     '  reaction_timeout:integer - Reactions are removed {reaction_timeout} minutes after being applied. If set to -1 reactions never times out.\n'
-    '  name:string - Name of the lobby.\n\n'
+    '  name:string - Name of the lobby.\n'
+    '  --buttons/--reactions - Join with Join/Leave buttons or with reactions. Can be given anywhere after the size, the default is set by the bot.\n\n'
     'Creates a lobby. Join lobbies by reacting to the lobby message. Once {size} members has been reached all members will be pinged in the channels where they reacted from.'))
+@metrics.timed('command_seconds', command='lobby')
 async def init_lobby(ctx, size: int, *args):
     await create_lobby(ctx, "Lobby", size, *args)
 
@@ -224,13 +474,42 @@ async def init_lobby(ctx, size: int, *args):
     '  size:integer - Size of lobby. Once reached all members are notifierd.\n'
     '  lobby_timeout:integer - Timeout time for lobby. After {timeout} minutes the lobby is closed. If set to -1 lobby never times out.\n'
     '  reaction_timeout:integer - Reactions are removed {reaction_timeout} minutes after being applied. If set to -1 reactions never times out.\n'
-    '  name:string - Name of the lobby.\n\n'
+    '  name:string - Name of the lobby.\n'
+    '  --buttons/--reactions - Join with Join/Leave buttons or with reactions. Can be given anywhere after the size, the default is set by the bot.\n\n'
     'Works the same way as !lobby. The exception being not closing lobby once it fills. Instead it resets the lobby so it can be used again.'))
+@metrics.timed('command_seconds', command='permlobby')
 async def init_perm_lobby(ctx, size: int, *args):
     await create_lobby(ctx, "PermanentLobby", size, *args)
 
+def admit(ctx, command, lobby=None):
+    # Quotas and load shedding for the commands that post lobby messages,
+    # lobby is the lobby being cloned. Counts only cover the lobbies of
+    # this process. Raises AssertionError with the reply to the user.
+    def reject(reason, message):
+        metrics.increment('admission_rejected_total', command=command, reason=reason)
+        raise AssertionError(message)
+
+    if admission.overloaded() != None:
+        reject('overload', 'The bot is under heavy load right now, new lobbies and clones are paused. '
+            'Try again in a few minutes.')
+    if lobby == None:
+        if 0 < MAX_LOBBIES_PER_AUTHOR <= len(registry.lobby_authors.get(ctx.author.id, {})):
+            reject('author', f'You already have the maximum of {MAX_LOBBIES_PER_AUTHOR} open lobbies. Close one with !closelobby first.')
+    elif 0 < MAX_CLONES_PER_LOBBY <= len(lobby.messages):
+        reject('clones', f'Lobby is already posted the maximum of {MAX_CLONES_PER_LOBBY} times.')
+    guild_lobbies = registry.lobby_guilds.get(ctx.guild.id, {}) if ctx.guild != None else {}
+    if lobby == None or lobby.hash not in guild_lobbies:
+        if 0 < MAX_LOBBIES_PER_GUILD <= len(guild_lobbies):
+            reject('guild', f'This server already has the maximum of {MAX_LOBBIES_PER_GUILD} open lobbies.')
+
 async def create_lobby(ctx, lobby_type, size, *args):
     lobby_types = {"PermanentLobby": PermanentLobby, "Lobby": Lobby}
+    modes = {'--reactions': MODE_REACTIONS, '--buttons': MODE_BUTTONS}
+
+    mode = LOBBY_MODE
+    for arg in args:
+        if arg in modes: mode = modes[arg]
+    args = [arg for arg in args if arg not in modes]
 
     assert size > 1 and size <= 1000, 'Invalid lobby size. Allowed [1, 1000].'
         
@@ -242,46 +521,43 @@ async def create_lobby(ctx, lobby_type, size, *args):
 
     assert timeout < 60*60*24, 'Invalid lobby timeout value'
     assert user_timeout < 60*60*24, 'Invalid user timeout value'
+    admit(ctx, 'lobby')
 
     name = ' '.join(args[2:])
 
     # Create a new lobby
     lobby = lobby_types[lobby_type](size, name, ctx.author.id, timeout, user_timeout, bot)
-
-    assert lobby.hash not in lobbies, 'Freak accident.'
-
-    await lobby.update_lock.acquire()
-    await lobby_lock.acquire()
-    try:
-        message = await lobby.postMessage(ctx)
-        assert message != None, 'Could not post lobby message'
-        lobbies[lobby.hash] = lobby
-        lobby_messages[message.id] = lobby
-        if ctx.author.id not in lobby_authors: lobby_authors[ctx.author.id] = []
-        lobby_authors[ctx.author.id].append(lobby)
-        await ctx.message.add_reaction('✅')
-    except: raise
-    finally: 
-        lobby.update_lock.release()
-        lobby_lock.release()
-
-    await saveLobbyDump()
+    lobby.shard = shards.shardOf(ctx.guild.id if ctx.guild != None else None)
+    lobby.mode = mode
+
+    assert lobby.hash not in registry.lobbies, 'Freak accident.'
+
+    # Not registered yet, so nothing else can change the lobby before it is
+    # added.
+    message = await lobby.postMessage(ctx)
+    assert message != None, 'Could not post lobby message'
+    registry.add(lobby, [message.id])
+    schedule_lobby(lobby)
+    store.markDirty(lobby)
+    # Other shards route events by the stored message index.
+    if shards.enabled(): await store.flush()
+    await ctx.message.add_reaction('✅')
 
 @bot.command(name='clonelobby', help='Clone an existing lobby to the current channel\nUsage: "!clonelobby {id:string}"\nClones the lobby with specified id to current channel. Cloned lobbies will mirror the original lobby. Changes done to either applies to both.')
+@metrics.timed('command_seconds', command='clonelobby')
 async def clone_lobby(ctx, identifier: str):
+    if await forward_command(ctx, 'clonelobby', identifier): return
+    lobbies = registry.lobbies
     assert identifier in lobbies, 'Lobby with id does not exist.'
     lobby = lobbies[identifier]
+    admit(ctx, 'clonelobby', lobby)
 
-    await lobbies[identifier].update_lock.acquire()
     try:
         assert lobby.allow_cloning or lobby.author_id==ctx.author.id, 'Lobby does not allow cloning.'
-        message = await lobbies[identifier].postMessage(ctx)
-        assert message != None, 'Could not post new message.'
-        lobby_messages[message.id] = lobbies[identifier]
+        await lobby.post(op_clone, ctx)
+        if shards.enabled(): await store.flush()
         await ctx.message.add_reaction('✅')
     except: pass
-    finally: lobbies[identifier].update_lock.release()
-    await saveLobbyDump()
 
 
 
@@ -291,6 +567,8 @@ async def clone_lobby(ctx, identifier: str):
 @edit_lobby.error
 @allow_cloning.error
 @close_lobby.error
+@stats.error
+@profile.error
 async def lobby_error(ctx, error):
     try:
         if hasattr(error, 'original'):
@@ -303,6 +581,8 @@ async def lobby_error(ctx, error):
             await ctx.send('Invalid command parameters. Check !help for proper usage of command.')
         elif isinstance(error, commands.MissingPermissions) or isinstance(error, discord.errors.Forbidden):
             await ctx.send(f'Bot does not have required permissions: {error}')
+        elif isinstance(error, commands.NotOwner):
+            await ctx.send('Only the bot owner can use this command.')
         else: 
             await ctx.send('Unexpected error while executing command.')
             raise
@@ -313,31 +593,169 @@ async def lobby_error(ctx, error):
 
 
 @bot.event
+@metrics.timed('event_seconds', event='on_raw_reaction_add')
 async def on_raw_reaction_add(payload):
-    if (payload.message_id not in lobby_messages):
+    if payload.user_id == bot.user.id: return
+    if await forward_event('reaction_add', payload.message_id, user_id=payload.user_id, emoji=str(payload.emoji)):
         return
-    lobby = lobby_messages[payload.message_id]
-    await lobby.update_lock.acquire()
-    await lobby.updateLobby()
-    if lobby.isFull():
-        await lobby.finalizeLobby()
-        if type(lobby) is Lobby:
-            await removeLobby(lobby.hash)
-        else:
-            await saveLobbyDump()
-    lobby.update_lock.release()
+    await reaction_add(payload.message_id, payload.user_id, payload.emoji)
 
 @bot.event
+@metrics.timed('event_seconds', event='on_raw_reaction_remove')
 async def on_raw_reaction_remove(payload):
-    if (payload.message_id not in lobby_messages): return
-    lobby = lobby_messages[payload.message_id]
-    await lobby.update_lock.acquire()
-    await lobby.updateLobby()
-    lobby.update_lock.release()
+    if payload.user_id == bot.user.id: return
+    if await forward_event('reaction_remove', payload.message_id, user_id=payload.user_id, emoji=str(payload.emoji)):
+        return
+    await reaction_remove(payload.message_id, payload.user_id, payload.emoji)
+
+@bot.event
+@metrics.timed('event_seconds', event='on_raw_reaction_clear')
+async def on_raw_reaction_clear(payload):
+    if await forward_event('reaction_clear', payload.message_id, emoji=None): return
+    await clear_message_reactions(payload.message_id)
+
+@bot.event
+@metrics.timed('event_seconds', event='on_raw_reaction_clear_emoji')
+async def on_raw_reaction_clear_emoji(payload):
+    if await forward_event('reaction_clear', payload.message_id, emoji=str(payload.emoji)): return
+    await clear_message_reactions(payload.message_id, payload.emoji)
 
+@bot.event
+async def on_socket_response(event):
+    # Called for every gateway event, only button presses are handled.
+    interaction = interactions.Interaction.fromEvent(event)
+    if interaction == None: return
+    await on_interaction(interaction)
+
+@metrics.timed('event_seconds', event='on_interaction')
+async def on_interaction(interaction):
+    if await forward_event('interaction', interaction.message_id, interaction=interaction.getData()): return
+    await interaction_press(interaction)
+
+@bot.event
+@metrics.timed('event_seconds', event='on_raw_message_delete')
+async def on_raw_message_delete(payload):
+    if await forward_event('message_delete', payload.message_id): return
+    await message_delete(payload.message_id)
+
+async def reaction_add(message_id, user_id, emoji):
+    lobby = registry.lobby_messages.get(message_id)
+    if lobby == None: return
+    await lobby.post(op_reaction_add, message_id, user_id, emoji)
+
+async def reaction_remove(message_id, user_id, emoji):
+    lobby = registry.lobby_messages.get(message_id)
+    if lobby == None: return
+    await lobby.post(op_reaction_remove, message_id, user_id, emoji)
+
+async def clear_message_reactions(message_id, emoji=None):
+    # Also received for the bot's own clears, members who reacted while a
+    # clear was queued are dropped here.
+    lobby = registry.lobby_messages.get(message_id)
+    if lobby == None: return
+    await lobby.post(op_reaction_clear, message_id, emoji)
+
+async def interaction_press(interaction):
+    lobby = registry.lobby_messages.get(interaction.message_id)
+    if lobby == None:
+        # The lobby was removed, or its buttons were not. Answered so the
+        # press does not show as failed.
+        await interaction.respond(bot, interactions.CHANNEL_MESSAGE,
+            {'content': 'This lobby is closed.', 'flags': interactions.EPHEMERAL})
+        return
+    future = lobby.post(op_interaction, interaction)
+    try: await asyncio.wait_for(asyncio.shield(future), interactions.DEADLINE)
+    except asyncio.TimeoutError:
+        # The mailbox is backed up. Acknowledged so the press does not
+        # fail, the clone is updated by the next render.
+        await interaction.respond(bot, interactions.DEFERRED_UPDATE_MESSAGE)
+        await future
+        return
+    except Exception as e:
+        # Acknowledged so the press does not show as failed.
+        print(f'Lobby {lobby.hash} press {interaction.custom_id} failed: {e!r}')
+        await interaction.respond(bot, interactions.DEFERRED_UPDATE_MESSAGE)
+        return
+
+    if interaction.outcome == 'closed':
+        await interaction.respond(bot, interactions.CHANNEL_MESSAGE,
+            {'content': 'This lobby is closed.', 'flags': interactions.EPHEMERAL})
+    # The pressed clone is updated with the response. A press that filled
+    # the lobby is only acknowledged, the fill edits every clone.
+    elif interaction.outcome == 'changed' and not lobby.finalized: await lobby.updateFromInteraction(interaction)
+    else: await interaction.respond(bot, interactions.DEFERRED_UPDATE_MESSAGE)
+
+async def message_delete(message_id):
+    lobby = registry.removeMessage(message_id)
+    if lobby == None: return
+    await lobby.post(op_message_delete, message_id)
+
+# Forwarding between shards.
+
+async def forward_event(op, message_id, **data):
+    # Events for clones of lobbies owned by another shard are forwarded to
+    # it. Returns True if the event was forwarded, other events are left to
+    # the local handler, which ignores messages of no open lobby.
+    if message_id in registry.lobby_messages: return False
+    if not shards.enabled() or message_id in other_messages: return False
+    shard = await store.messageShard(message_id)
+    if shard == None:
+        # A new clone can be reacted to before the owner has saved it, only
+        # messages older than that are remembered.
+        created = ((message_id >> 22) + discord.utils.DISCORD_EPOCH) / 1000
+        if time.time() - created < OTHER_MESSAGES_MIN_AGE: return False
+        if len(other_messages) >= OTHER_MESSAGES_CACHE: other_messages.clear()
+        other_messages.add(message_id)
+        return False
+    if shards.isLocal(shard): return False
+    await store.forward(shard, {'op': op, 'message_id': message_id, **data})
+    return True
+
+async def forward_command(ctx, name, lobby_id, *args):
+    # Commands for lobbies owned by another shard are forwarded to it, the
+    # owner replies to the command message. Returns True if forwarded.
+    if not shards.enabled() or lobby_id in registry.lobbies: return False
+    shard = await store.lobbyShard(lobby_id)
+    if shard == None or shards.isLocal(shard): return False
+    await store.forward(shard, {'op': 'command', 'name': name, 'args': [lobby_id, *args],
+        'channel_id': ctx.channel.id, 'message_id': ctx.message.id, 'author_id': ctx.author.id})
+    return True
+
+async def run_forwarded():
+    if not shards.enabled(): return
+    await bot.wait_until_ready()
+    while True:
+        try:
+            # Started in order, so operations on the same lobby are posted to
+            # its mailbox in the order they were forwarded.
+            for op in await store.takeOps(shards.localShards()):
+                asyncio.ensure_future(apply_forwarded(op))
+        except Exception as e: print(f'Could not read forwarded operations: {e}')
+        await asyncio.sleep(shards.FORWARD_INTERVAL)
+
+@metrics.timed('task_seconds', task='apply_forwarded')
+async def apply_forwarded(op):
+    if op['op'] == 'reaction_add': await reaction_add(op['message_id'], op['user_id'], op['emoji'])
+    elif op['op'] == 'reaction_remove': await reaction_remove(op['message_id'], op['user_id'], op['emoji'])
+    elif op['op'] == 'reaction_clear': await clear_message_reactions(op['message_id'], op['emoji'])
+    elif op['op'] == 'message_delete': await message_delete(op['message_id'])
+    elif op['op'] == 'interaction': await interaction_press(interactions.Interaction(**op['interaction']))
+    elif op['op'] == 'command':
+        channel = bot.get_channel(op['channel_id'])
+        if channel == None: channel = await bot.fetch_channel(op['channel_id'])
+        ctx = shards.ForwardedContext(channel, op['message_id'], op['author_id'])
+        try: await bot.all_commands[op['name']].callback(ctx, *op['args'])
+        except Exception as e:
+            try: await lobby_error(ctx, commands.CommandInvokeError(e))
+            except: pass
 
 
 
-bot.loop.create_task(loadLobbyDump())
-bot.loop.create_task(chron_checkup())
-bot.run(TOKEN)
+if __name__ == '__main__':
+    bot.loop.create_task(loadLobbyDump())
+    bot.loop.create_task(run_timers())
+    bot.loop.create_task(start_metrics())
+    bot.loop.create_task(run_forwarded())
+    bot.loop.create_task(admission.monitorLag())
+    profiler.startWatchdog(bot.loop)
+    bot.run(TOKEN)
@@ -0,0 +1,39 @@
+import os
+import asyncio
+import time
+
+import metrics
+from dispatcher import dispatcher
+
+SHED_QUEUE_DEPTH = int(os.getenv('SHED_QUEUE_DEPTH', 2000)) # Queued Discord requests above which the bot sheds load, 0 to disable
+SHED_LOOP_LAG = float(os.getenv('SHED_LOOP_LAG', 0.5)) # Event loop lag in seconds above which the bot sheds load, 0 to disable
+SHED_RENDER_DELAY = float(os.getenv('SHED_RENDER_DELAY', 10)) # Seconds to collect changes before editing messages while shedding
+LAG_INTERVAL = 0.5 # Seconds between event loop lag samples
+
+# While the outgoing request backlog or the event loop lag is above its
+# threshold the bot is overloaded. New lobbies and clones are refused,
+# since every clone adds requests to all later updates, and renders are
+# collected for longer so more changes share an edit.
+
+loop_lag = 0.0 # Smoothed event loop lag in seconds
+
+async def monitorLag():
+    global loop_lag
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = time.perf_counter() - start - LAG_INTERVAL
+        loop_lag = 0.7 * loop_lag + 0.3 * lag
+        metrics.setGauge('event_loop_lag_seconds', loop_lag)
+
+def overloaded():
+    # Reason the bot is overloaded, None if it is not.
+    if SHED_QUEUE_DEPTH > 0 and dispatcher.depth > SHED_QUEUE_DEPTH: return 'backlog'
+    if SHED_LOOP_LAG > 0 and loop_lag > SHED_LOOP_LAG: return 'lag'
+    return None
+
+def renderDelay(delay):
+    reason = overloaded()
+    if reason == None: return delay
+    metrics.increment('shed_total', action='render_delay', reason=reason)
+    return max(delay, SHED_RENDER_DELAY)
@@ -0,0 +1,494 @@
+import os
+import sys
+import gc
+import io
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+
+import fakediscord
+
+# Replays scripted workloads against the bot on top of fakediscord and
+# reports REST calls per reaction, join->render latency, event loop lag and
+# memory. Exits with status 1 when a budget is exceeded.
+#
+# Usage: python benchmark.py [--preset small|large] [--lobbies N] ...
+
+PRESETS = {
+    'small': {'lobbies': 200, 'clones': 5, 'channels': 50, 'users': 2000, 'reactions': 5000,
+        'duration': 10, 'size': 10},
+    'large': {'lobbies': 5000, 'clones': 20, 'channels': 500, 'users': 50000, 'reactions': 50000,
+        'duration': 30, 'size': 10},
+}
+
+BUDGETS = {
+    'lag_ms': 250,
+    'bytes_per_lobby': 20000,
+    'bytes_per_loaded_lobby': 20000,
+    # Any of these is a bug.
+    'joins_unrendered': 0,
+    'late_interactions': 0,
+    'reset_members_left': 0,
+    'idle_edits': 0,
+    'reconcile_mismatched_lobbies': 0,
+}
+WORKLOAD_BUDGETS = ['calls_per_reaction', 'p95_ms'] # Follow from the workload, see workloadBudgets
+
+BOT_ID = 1
+OWNER_ID = 2
+
+RESET_SIZE = 50 # Members of the permanent lobby filled in the reset scenario
+RESET_CLONES = 10
+OUTAGE_REACTIONS = 200 # Reactions made while the gateway is disconnected in the reconnect scenario
+LOADED_LOBBIES = 50 # Lobbies joined to one member short of full in the loaded scenario
+IDLE_LOBBIES = 20 # Lobbies with a timer left alone in the idle scenario
+IDLE_MINUTES = 20
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Offline load benchmark for the lobby bot.')
+    parser.add_argument('--preset', choices=list(PRESETS), default='small')
+    for name in PRESETS['small']:
+        parser.add_argument(f'--{name}', type=float if name == 'duration' else int)
+    parser.add_argument('--latency', type=float, default=50, help='Mean REST latency in ms.')
+    parser.add_argument('--rate-limit', default='5/5',
+        help='Requests/seconds allowed per channel and operation during the storm, "none" to disable.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-manage-messages', action='store_true',
+        help='Run without Manage Messages, reactions are then removed one by one.')
+    parser.add_argument('--buttons', action='store_true', help='Create lobbies in button mode, users press Join/Leave.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Show bot output.')
+    for name in budgetNames():
+        parser.add_argument(f'--budget-{name.replace("_", "-")}', type=float)
+    args = parser.parse_args()
+    for name, value in PRESETS[args.preset].items():
+        if getattr(args, name) == None: setattr(args, name, value)
+    for name, value in BUDGETS.items():
+        if getattr(args, f'budget_{name}') == None: setattr(args, f'budget_{name}', value)
+    return args
+
+def budgetNames():
+    return list(BUDGETS) + WORKLOAD_BUDGETS
+
+def workloadBudgets(report, args):
+    # A reaction may cost one edit, and a fill one notification and one
+    # final edit per clone, shared by the reactions it takes to fill.
+    # A join has to show once every clone in its channel could be edited
+    # once after the storm at the rate limit, or once the storm's requests
+    # could be sent with the dispatcher's slots all busy, whichever is
+    # later.
+    from dispatcher import DISPATCH_CONCURRENCY, parseRateLimit
+    rate_limit = parseRateLimit(args.rate_limit)
+    channel_pass = 0
+    if rate_limit != None: channel_pass = args.lobbies * args.clones / args.channels * rate_limit[1] / rate_limit[0]
+    # The fake's latency is uniform between one and two times --latency.
+    throughput = DISPATCH_CONCURRENCY / (1.5 * args.latency / 1000)
+    requests = report['storm_calls'] - report['interaction_callbacks']
+    return {
+        'calls_per_reaction': round(1 + 2 * args.clones / args.size, 3),
+        'p95_ms': round((args.duration + max(channel_pass, requests / throughput)) * 1000),
+    }
+
+def percentile(values, p):
+    if len(values) == 0: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def deepSize(roots, stop_types, skip=()):
+    # Bytes reachable from roots without following shared infrastructure.
+    seen = set(skip)
+    size = 0
+    stack = list(roots)
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, stop_types): continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+def bytesPerLobby(app, lobbies=None):
+    # Shared objects (bot, channels, guilds and cached users) are not
+    # counted, the Member objects discord.py creates per event are.
+    stop_types = (type, types.ModuleType, types.FunctionType, asyncio.AbstractEventLoop, asyncio.Future,
+        fakediscord.FakeBackend, fakediscord.Bot, fakediscord.FakeChannel, fakediscord.FakeGuild)
+    if lobbies == None: lobbies = list(app.registry.lobbies.values())
+    shared = set(id(user) for user in app.bot.backend.users.values())
+    return deepSize(lobbies, stop_types, shared) // max(1, len(lobbies))
+
+class LagSampler():
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.running = True
+
+    async def run(self):
+        while self.running:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - start - self.interval)
+
+class JoinTracker():
+    # Measures the time from a reaction that makes a user join until the
+    # clone the user reacted on shows them.
+    def __init__(self):
+        self.pending = {} # message_id -> {user_id: start}
+        self.lobbies = {} # message_id -> lobby
+        self.latencies = []
+
+    def joined(self, lobby, message_id, user_id):
+        self.pending.setdefault(message_id, {}).setdefault(user_id, time.perf_counter())
+        self.lobbies[message_id] = lobby
+
+    def onEdit(self, message, now):
+        waiting = self.pending.get(message.id)
+        if waiting == None: return
+        for user_id in list(waiting):
+            if f'<@{user_id}>' in message.content:
+                self.latencies.append(now - waiting.pop(user_id))
+        if len(waiting) == 0: del self.pending[message.id]
+
+    def unrendered(self):
+        # Members never shown on the clone they joined on. Reactions that
+        # arrived after another one filled the lobby, or that were taken
+        # back before a render, made no one join.
+        return sum(1 for message_id, waiting in self.pending.items()
+            for user_id in waiting if user_id in self.lobbies[message_id].members)
+
+async def quiesce(app, backend, dispatcher):
+    # Waits until no renders are pending, no mailbox is being worked and no
+    # requests are queued or in flight.
+    idle = 0
+    while idle < 3:
+        await asyncio.sleep(0.2)
+        busy = dispatcher.depth > 0 or backend.in_flight > 0 or any(
+            lobby.render_task != None or lobby.mailbox.busy() for lobby in app.registry.lobbies.values())
+        idle = 0 if busy else idle + 1
+
+async def setup(app, backend, args, rng):
+    guilds = [backend.createGuild(f'guild{i}') for i in range(max(1, args.channels // 10))]
+    channels = [backend.createChannel(guilds[i % len(guilds)], f'channel{i}') for i in range(args.channels)]
+    users = [backend.createUser(f'user{i}') for i in range(args.users)]
+    semaphore = asyncio.Semaphore(64)
+
+    async def createLobby(i):
+        async with semaphore:
+            author = users[i % len(users)]
+            channel = rng.choice(channels)
+            await backend.invoke('lobby', channel, author, args.size, '30', '30', f'bench {i}', *modeArgs(args))
+            lobby = list(app.registry.lobby_authors[author.id].values())[-1]
+            clone_channels = rng.sample(channels, min(len(channels), args.clones - 1))
+            for clone_channel in clone_channels:
+                await backend.invoke('clonelobby', clone_channel, author, lobby.hash)
+
+    await asyncio.gather(*[createLobby(i) for i in range(args.lobbies)])
+    return users
+
+def modeArgs(args):
+    return ['--buttons'] if args.buttons else []
+
+def isJoined(args, lobby, message, user):
+    # Whether the user has reacted to the message, or joined in button mode.
+    if args.buttons: return user.id in lobby.members
+    reaction = message.getReaction('✅')
+    return reaction != None and user.id in reaction.user_ids
+
+def join(backend, args, user, message):
+    if args.buttons: backend.press(user, message, 'lobby_join')
+    else: backend.react(user, message)
+
+def leave(backend, args, user, message):
+    if args.buttons: backend.press(user, message, 'lobby_leave')
+    else: backend.unreact(user, message)
+
+async def storm(app, backend, args, rng, users, tracker):
+    # Reactions spread evenly over the duration, mostly joins with some
+    # leaves. Picks from a lobby list refreshed every 100 events.
+    events = 0
+    targets = []
+    start = time.perf_counter()
+    for i in range(args.reactions):
+        if i % 100 == 0:
+            targets = [(lobby, [backend.messages[message_id] for message_id in lobby.messages if message_id in backend.messages])
+                for lobby in app.registry.lobbies.values()]
+            targets = [target for target in targets if len(target[1]) > 0]
+            if len(targets) == 0: break
+        # Yields for every event even when behind schedule, the gateway
+        # delivers events one read at a time.
+        await asyncio.sleep(max(0, start + i * args.duration / args.reactions - time.perf_counter()))
+
+        lobby, messages = rng.choice(targets)
+        message = rng.choice(messages)
+        user = rng.choice(users)
+        if isJoined(args, lobby, message, user):
+            if rng.random() < 0.2:
+                leave(backend, args, user, message)
+                events += 1
+            continue
+        if user.id not in lobby.members and not lobby.finalized: tracker.joined(lobby, message.id, user.id)
+        join(backend, args, user, message)
+        events += 1
+    return events
+
+async def loadedScenario(app, backend, args, rng, users):
+    # Creates LOADED_LOBBIES lobbies like the storm's and joins all but one
+    # of their members on random clones, the most a lobby holds before it
+    # is removed. Returns the bytes per lobby of these.
+    from dispatcher import dispatcher
+    channels = list(backend.channels.values())
+    author = users[-3]
+    lobbies = []
+    for i in range(LOADED_LOBBIES):
+        await backend.invoke('lobby', rng.choice(channels), author, args.size, '30', '30', f'loaded {i}', *modeArgs(args))
+        lobby = list(app.registry.lobby_authors[author.id].values())[-1]
+        for channel in rng.sample(channels, min(len(channels), args.clones - 1)):
+            await backend.invoke('clonelobby', channel, author, lobby.hash)
+        lobbies.append(lobby)
+    await quiesce(app, backend, dispatcher)
+    for lobby in lobbies:
+        messages = [backend.messages[message_id] for message_id in lobby.messages]
+        for user in rng.sample(users[:-3], args.size - 1): join(backend, args, user, rng.choice(messages))
+    await quiesce(app, backend, dispatcher)
+    return bytesPerLobby(app, lobbies)
+
+async def resetScenario(app, backend, args, rng, users):
+    # Fills a permanent lobby cloned to RESET_CLONES channels. Returns the
+    # calls made for the reaction that fills it: notifications, the reset
+    # and the render of the emptied lobby.
+    from dispatcher import dispatcher
+    channels = rng.sample(list(backend.channels.values()), min(RESET_CLONES, len(backend.channels)))
+    author = users[-1]
+    await backend.invoke('permlobby', channels[0], author, RESET_SIZE, '-1', '-1', 'reset', *modeArgs(args))
+    lobby = list(app.registry.lobby_authors[author.id].values())[-1]
+    for channel in channels[1:]:
+        await backend.invoke('clonelobby', channel, author, lobby.hash)
+    messages = [backend.messages[message_id] for message_id in lobby.messages]
+    members = rng.sample(users[:-1], RESET_SIZE)
+    for user in members[:-1]: join(backend, args, user, rng.choice(messages))
+    await quiesce(app, backend, dispatcher)
+
+    calls = dict(backend.calls)
+    start = time.perf_counter()
+    join(backend, args, members[-1], rng.choice(messages))
+    await quiesce(app, backend, dispatcher)
+    fill_calls = {op: count - calls.get(op, 0) for op, count in backend.calls.items() if count > calls.get(op, 0)}
+    left = sum(reaction.count for message in messages for reaction in message.reactions)
+    return fill_calls, time.perf_counter() - start, left, len(lobby.members)
+
+async def idleScenario(app, backend, args, rng, users):
+    # Leaves IDLE_LOBBIES lobbies with a lobby timer and no members alone for
+    # IDLE_MINUTES. The bot's clock is moved forward a minute at a time and
+    # the bot is let run its timers. Returns the edits of their messages and
+    # the calls made for all lobbies meanwhile.
+    from dispatcher import dispatcher
+    channels = list(backend.channels.values())
+    author = users[-2]
+    message_ids = set()
+    for i in range(IDLE_LOBBIES):
+        await backend.invoke('lobby', rng.choice(channels), author, args.size, str(2 * IDLE_MINUTES), '-1',
+            f'idle {i}', *modeArgs(args))
+        lobby = list(app.registry.lobby_authors[author.id].values())[-1]
+        for channel in rng.sample(channels, min(len(channels), args.clones - 1)):
+            await backend.invoke('clonelobby', channel, author, lobby.hash)
+        message_ids.update(lobby.messages)
+    await quiesce(app, backend, dispatcher)
+
+    edits = []
+    def onEdit(message, now):
+        if message.id in message_ids: edits.append(message.id)
+    backend.edit_listeners.append(onEdit)
+    calls = dict(backend.calls)
+    wall_time = time.time
+    offset = 0
+    time.time = lambda: wall_time() + offset
+    try:
+        for _ in range(IDLE_MINUTES):
+            offset += 60
+            app.timers.wakeup.set()
+            await quiesce(app, backend, dispatcher)
+    finally:
+        time.time = wall_time
+        backend.edit_listeners.remove(onEdit)
+    idle_calls = {op: count - calls.get(op, 0) for op, count in backend.calls.items() if count > calls.get(op, 0)}
+    return len(edits), idle_calls
+
+async def reconnectScenario(app, backend, args, rng, users):
+    # Reacts while the gateway is disconnected and resumes. Returns the calls
+    # made reconciling, the time it took and the lobbies whose members still
+    # differ from the reactions on their messages.
+    from dispatcher import dispatcher
+    lobbies = [lobby for lobby in app.registry.lobbies.values() if not lobby.finalized]
+    calls = dict(backend.calls)
+    backend.disconnect()
+    for i in range(OUTAGE_REACTIONS):
+        lobby = rng.choice(lobbies)
+        message = backend.messages.get(rng.choice(list(lobby.messages)))
+        if message == None: continue
+        user = rng.choice(users)
+        reaction = message.getReaction('✅')
+        if reaction != None and user.id in reaction.user_ids: message.removeReactionUser('✅', user)
+        else: message.addReactionUser('✅', user)
+    start = time.perf_counter()
+    backend.resume()
+    await asyncio.sleep(0)
+    while app.reconcile_task != None: await asyncio.sleep(0.1)
+    await quiesce(app, backend, dispatcher)
+    reconcile_calls = {op: count - calls.get(op, 0) for op, count in backend.calls.items() if count > calls.get(op, 0)}
+
+    # Reactions the bot could not remove from members it dropped do not
+    # count, it knows of them.
+    mismatched = 0
+    for lobby in app.registry.lobbies.values():
+        user_ids = set(user_id for message_id in lobby.messages if message_id in backend.messages
+            for reaction in backend.messages[message_id].reactions for user_id in reaction.user_ids
+            if user_id not in lobby.left_reactions.get(message_id, {}).get(reaction.emoji, ()))
+        user_ids.discard(BOT_ID)
+        if user_ids != set(lobby.members): mismatched += 1
+    return reconcile_calls, time.perf_counter() - start, mismatched
+
+async def run(app, args):
+    from dispatcher import dispatcher, parseRateLimit
+    rng = random.Random(args.seed)
+    rate_limit = parseRateLimit(args.rate_limit)
+    backend = fakediscord.FakeBackend(args.latency / 1000, args.latency / 1000, None, args.seed)
+    backend.manage_messages = not args.no_manage_messages
+    # The fixture is set up without rate limits, the storm and later
+    # scenarios run with them and the bot paces its requests to match.
+    dispatcher.rate_limit = None
+    app.bot.attach(backend, BOT_ID)
+    app.bot.owner_id = OWNER_ID
+    tasks = [asyncio.ensure_future(app.loadLobbyDump()), asyncio.ensure_future(app.run_timers()),
+        asyncio.ensure_future(app.admission.monitorLag())]
+    app.bot.setReady()
+    await asyncio.sleep(0)
+
+    report = {'preset': args.preset, 'lobbies': args.lobbies, 'clones': args.clones, 'reactions': args.reactions}
+
+    setup_start = time.perf_counter()
+    users = await setup(app, backend, args, rng)
+    await quiesce(app, backend, dispatcher)
+    report['setup_seconds'] = round(time.perf_counter() - setup_start, 2)
+    report['setup_calls'] = backend.totalCalls()
+
+    report['bytes_per_lobby'] = bytesPerLobby(app)
+
+    backend.calls.clear()
+    backend.rate_limit = rate_limit
+    dispatcher.rate_limit = rate_limit
+    tracker = JoinTracker()
+    backend.edit_listeners.append(tracker.onEdit)
+    sampler = LagSampler()
+    sampler_task = asyncio.ensure_future(sampler.run())
+
+    storm_start = time.perf_counter()
+    events = await storm(app, backend, args, rng, users, tracker)
+    await quiesce(app, backend, dispatcher)
+    sampler.running = False
+    await sampler_task
+
+    calls = backend.totalCalls()
+    report['storm_seconds'] = round(time.perf_counter() - storm_start, 2)
+    report['reaction_events'] = events
+    report['storm_calls'] = calls
+    report['calls_by_op'] = dict(backend.calls)
+    report['rate_limited'] = sum(backend.rate_limited.values())
+    # Every button press is answered with one interaction callback. They
+    # are not rate limited per channel and are counted on their own.
+    callbacks = backend.calls['interaction_callback']
+    report['interaction_callbacks'] = callbacks
+    report['calls_per_reaction'] = round((calls - callbacks) / max(1, events), 3)
+    report['edits_skipped'] = app.metrics.counters.get(app.metrics.key('edits_skipped_total', {}), 0)
+    latencies = [latency * 1000 for latency in tracker.latencies]
+    report['joins_rendered'] = len(latencies)
+    report['joins_unrendered'] = tracker.unrendered()
+    for p in [50, 95, 99]:
+        value = percentile(latencies, p)
+        report[f'p{p}_ms'] = None if value == None else round(value, 1)
+    lags = [lag * 1000 for lag in sampler.samples]
+    report['lag_p99_ms'] = round(percentile(lags, 99) or 0, 1)
+    report['lag_ms'] = round(max(lags, default=0), 1)
+    report['rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    # The storm's lobbies have filled and been removed by now, the memory
+    # of lobbies under load is measured on lobbies that stay open.
+    report['bytes_per_loaded_lobby'] = await loadedScenario(app, backend, args, rng, users)
+
+    fill_calls, fill_seconds, reactions_left, members_left = await resetScenario(app, backend, args, rng, users)
+    report['reset_calls'] = sum(fill_calls.values())
+    report['reset_calls_by_op'] = fill_calls
+    report['reset_seconds'] = round(fill_seconds, 2)
+    report['reset_reactions_left'] = reactions_left
+    report['reset_members_left'] = members_left
+
+    report['late_interactions'] = backend.late_interactions
+
+    # Edits of messages no one touched, a lobby timer shown in the message
+    # should not need any.
+    report['idle_edits'], report['idle_calls_by_op'] = await idleScenario(app, backend, args, rng, users)
+    report['shed'] = sum(value for (name, _), value in app.metrics.counters.items()
+        if name in ['shed_total', 'admission_rejected_total'])
+
+    # Button presses missed while disconnected are lost for good.
+    if not args.buttons:
+        reconcile_calls, reconcile_seconds, mismatched = await reconnectScenario(app, backend, args, rng, users)
+        report['reconcile_calls_by_op'] = reconcile_calls
+        report['reconcile_seconds'] = round(reconcile_seconds, 2)
+        report['reconcile_reactions'] = {result: app.metrics.counters.get(
+            app.metrics.key('reconcile_reactions_total', {'result': result}), 0) for result in ['matched', 'paged']}
+        report['reconcile_mismatched_lobbies'] = mismatched
+
+    for task in tasks: task.cancel()
+    return report
+
+def checkBudgets(report, args):
+    failures = []
+    workload = workloadBudgets(report, args)
+    for name in budgetNames():
+        budget = getattr(args, f'budget_{name}')
+        if budget == None: budget = workload[name]
+        value = report.get(name)
+        if value != None and value > budget: failures.append(f'{name} {value} > {budget}')
+    return failures
+
+def main():
+    args = parseArgs()
+    database = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    os.environ.update({'DISCORD_TOKEN': 'benchmark', 'BOT_ID': str(BOT_ID), 'LOBBY_DB': database})
+    os.environ.setdefault('LOBBY_TIMEOUT', '3600')
+    # The fixture puts more lobbies in a server than the default quotas
+    # allow, and load shedding would change what is measured. Both can be
+    # turned on again from the environment.
+    for name in ['MAX_LOBBIES_PER_AUTHOR', 'MAX_LOBBIES_PER_GUILD', 'MAX_CLONES_PER_LOBBY', 'SHED_QUEUE_DEPTH', 'SHED_LOOP_LAG']:
+        os.environ.setdefault(name, '0')
+
+    fakediscord.install()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+            import SuperLobbyBot as app
+            report = loop.run_until_complete(run(app, args))
+            loop.run_until_complete(app.store.flush())
+    finally:
+        for path in [database, database + '-wal', database + '-shm']:
+            if os.path.exists(path): os.remove(path)
+
+    failures = checkBudgets(report, args)
+    report['budget_failures'] = failures
+    if args.json: print(json.dumps(report, indent=2))
+    else:
+        for name, value in report.items():
+            print(f'{name}: {value}')
+    if len(failures) > 0:
+        print('FAIL: ' + '; '.join(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
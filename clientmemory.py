@@ -0,0 +1,133 @@
+import os
+import gc
+import sys
+import json
+import argparse
+import itertools
+import subprocess
+
+# Measures the memory discord.py's caches take under each client profile.
+# Builds the client of a profile without connecting and feeds its
+# connection state the gateway events Discord would send with the
+# profile's intents: guild creates, messages and reactions. Every profile
+# runs in its own process and the resident set size is reported.
+#
+# Usage: python clientmemory.py [--guilds N] [--messages N] ...
+
+PROFILES = ['default', 'minimal']
+BOT_ID = 1
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Memory of discord.py caches per client profile.')
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=20, help='Text channels per guild.')
+    parser.add_argument('--roles', type=int, default=20, help='Roles per guild.')
+    parser.add_argument('--emojis', type=int, default=20, help='Custom emojis per guild.')
+    parser.add_argument('--voice-members', type=int, default=5, help='Members in voice channels per guild.')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages sent over all guilds.')
+    parser.add_argument('--reactions', type=int, default=20000, help='Reactions added over all guilds.')
+    parser.add_argument('--profile', choices=PROFILES, help='Measure one profile in this process.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    return parser.parse_args()
+
+def residentMB():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def userData(user_id):
+    return {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0001', 'avatar': None}
+
+def memberData(user_id):
+    return {'user': userData(user_id), 'roles': [], 'joined_at': '2021-01-01T00:00:00+00:00', 'deaf': False, 'mute': False}
+
+def guildData(args, intents, guild_id, ids):
+    channels = [{'id': str(next(ids)), 'type': 0, 'name': f'channel{i}', 'position': i, 'permission_overwrites': []}
+        for i in range(args.channels)]
+    voice_channel = {'id': str(next(ids)), 'type': 2, 'name': 'voice', 'position': 0, 'permission_overwrites': []}
+    roles = [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+        'hoist': False, 'managed': False, 'mentionable': False}]
+    roles += [{'id': str(next(ids)), 'name': f'role{i}', 'permissions': '0', 'position': i + 1, 'color': 0,
+        'hoist': False, 'managed': False, 'mentionable': False} for i in range(args.roles)]
+    emojis = [{'id': str(next(ids)), 'name': f'emoji{i}', 'roles': [], 'require_colons': True,
+        'managed': False, 'animated': False, 'available': True} for i in range(args.emojis)]
+    # The bot's own member is always sent, members in voice channels only
+    # with the voice states intent.
+    members = [memberData(BOT_ID)]
+    voice_states = []
+    if intents.voice_states:
+        for _ in range(args.voice_members):
+            user_id = next(ids)
+            members.append(memberData(user_id))
+            voice_states.append({'user_id': str(user_id), 'channel_id': voice_channel['id'], 'session_id': 'x',
+                'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False, 'suppress': False})
+    return {'id': str(guild_id), 'name': f'guild{guild_id}', 'owner_id': str(next(ids)), 'region': 'europe',
+        'channels': channels + [voice_channel], 'roles': roles, 'emojis': emojis, 'members': members,
+        'voice_states': voice_states, 'member_count': 1000, 'large': True, 'features': []}
+
+def measure(args, profile):
+    import discord
+    import profiles
+
+    start = residentMB()
+    client = discord.Client(**profiles.clientOptions(profile))
+    state = client._connection
+    intents = state._intents
+    state.user = discord.ClientUser(state=state, data=userData(BOT_ID))
+
+    ids = itertools.count(10**17)
+    guilds = []
+    for _ in range(args.guilds):
+        data = guildData(args, intents, next(ids), ids)
+        guild = state._add_guild_from_data(data)
+        guilds.append((guild, [int(channel['id']) for channel in data['channels'][:-1]]))
+
+    if intents.guild_messages:
+        for i in range(args.messages):
+            guild, channel_ids = guilds[i % len(guilds)]
+            user_id = next(ids)
+            state.parse_message_create({'id': str(next(ids)), 'channel_id': str(channel_ids[i % len(channel_ids)]),
+                'guild_id': str(guild.id), 'author': userData(user_id), 'member': memberData(user_id),
+                'content': f'message {i} ' + 'x' * 40, 'timestamp': '2021-01-01T00:00:00+00:00',
+                'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0})
+
+    if intents.guild_reactions:
+        messages = list(state._messages or [])
+        for i in range(args.reactions):
+            guild, channel_ids = guilds[i % len(guilds)]
+            message_id = messages[i % len(messages)].id if len(messages) > 0 else next(ids)
+            user_id = next(ids)
+            state.parse_message_reaction_add({'user_id': str(user_id), 'channel_id': str(channel_ids[0]),
+                'message_id': str(message_id), 'guild_id': str(guild.id), 'member': memberData(user_id),
+                'emoji': {'id': None, 'name': '✅'}})
+
+    gc.collect()
+    return {
+        'profile': profile,
+        'guilds': args.guilds,
+        'rss_mb': round(residentMB(), 1),
+        'cache_mb': round(residentMB() - start, 1),
+        'cached_messages': len(state._messages or []),
+        'cached_members': sum(len(guild._members) for guild, _ in guilds),
+        'cached_users': len(state._users),
+    }
+
+def main():
+    args = parseArgs()
+    if args.profile != None:
+        print(json.dumps(measure(args, args.profile)))
+        return
+
+    reports = []
+    for profile in PROFILES:
+        command = [sys.executable, __file__, '--profile', profile] + [arg for arg in sys.argv[1:] if arg != '--json']
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+    if args.json: print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print(', '.join(f'{name}: {value}' for name, value in report.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import os
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+import metrics
+
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', 16)) # Max requests in flight over all buckets
+DISPATCH_RATE_LIMIT = os.getenv('DISPATCH_RATE_LIMIT', '5/5') # Requests/seconds of each paced operation per bucket, "none" to disable
+PACED_OPS = ['send', 'edit'] # Operations Discord limits per channel at the rate above
+BUCKET_STATS_LIMIT = 1000 # Buckets with wait statistics, the least recently used are dropped
+SLOWEST_BUCKETS = 10 # Buckets exported in dispatch_bucket_wait_seconds
+
+# Lower value is sent first.
+PRIORITY_NOTIFY = 0 # Fill notifications, command replies and lobby closes
+PRIORITY_RENDER = 1 # Membership changes
+PRIORITY_RECONCILE = 2 # Fetches to reconcile state
+
+class Request():
+    def __init__(self, bucket, priority, func, key, op):
+        self.bucket = bucket
+        self.priority = priority
+        self.func = func
+        self.key = key
+        self.op = op
+        self.future = asyncio.get_event_loop().create_future()
+        self.queued_at = time.perf_counter()
+        self.source = metrics.current_source.get()
+
+def parseRateLimit(value):
+    if value == 'none': return None
+    limit, window = value.split('/')
+    return (int(limit), float(window))
+
+class Dispatcher():
+    # Queues outgoing Discord requests per bucket, normally the channel id
+    # since Discord rate limits message edits, sends and reactions per
+    # channel. Each bucket sends one request at a time, highest priority
+    # first. A request submitted with a key that is already queued in the
+    # bucket supersedes it: the old request is dropped and both callers get
+    # the result of the new one.
+    #
+    # Sends and edits are paced to the rate limit in the bucket. discord.py
+    # waits out a 429 inside the request, which would hold one of the
+    # concurrency slots and stall every other bucket meanwhile. While the
+    # first request waits for its operation's limit, requests of other
+    # operations in the bucket are sent.
+    def __init__(self, concurrency=DISPATCH_CONCURRENCY, rate_limit=parseRateLimit(DISPATCH_RATE_LIMIT)):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limit = rate_limit # (requests, seconds) or None
+        self.sent = {} # bucket -> {op: deque of send times within the rate limit window}
+        self.counter = itertools.count()
+        self.queues = {} # bucket -> heap of (priority, sequence, request)
+        self.queued = {} # (bucket, key) -> request
+        self.workers = {} # bucket -> task
+        self.depth = 0
+        self.bucket_stats = {} # bucket -> [requests, total wait, max wait], least recently used first
+
+    def submit(self, bucket, priority, func, key=None, op='request'):
+        # func is called without arguments and returns the coroutine to run.
+        # Returns a future with the result of the request, callers that may
+        # be cancelled should shield it since superseded requests share it.
+        if key != None and (bucket, key) in self.queued:
+            request = self.queued[(bucket, key)]
+            request.func = func
+            request.op = op
+            metrics.increment('dispatch_superseded_total')
+            if priority < request.priority:
+                request.priority = priority
+                heapq.heappush(self.queues[bucket], (priority, next(self.counter), request))
+            return request.future
+
+        request = Request(bucket, priority, func, key, op)
+        if key != None: self.queued[(bucket, key)] = request
+        heapq.heappush(self.queues.setdefault(bucket, []), (priority, next(self.counter), request))
+        self.depth += 1
+        metrics.setGauge('dispatch_queue_depth', self.depth)
+        if bucket not in self.workers:
+            self.workers[bucket] = asyncio.ensure_future(self.runBucket(bucket))
+        return request.future
+
+    async def runBucket(self, bucket):
+        queue = self.queues[bucket]
+        try:
+            while len(queue) > 0:
+                # Rate limits are waited for without taking a slot, a request
+                # submitted meanwhile may come first.
+                index, delay = self.nextRequest(bucket, queue)
+                if index == None:
+                    await asyncio.sleep(delay)
+                    continue
+                if index == 0: priority, _, request = heapq.heappop(queue)
+                else:
+                    priority, _, request = queue[index]
+                    queue[index] = queue[-1]
+                    queue.pop()
+                    heapq.heapify(queue)
+                # Stale entry left behind when a superseding request raised
+                # the priority.
+                if priority != request.priority: continue
+                if request.key != None: del self.queued[(bucket, request.key)]
+                self.depth -= 1
+                metrics.setGauge('dispatch_queue_depth', self.depth)
+                if request.future.done(): continue
+
+                async with self.semaphore:
+                    self.recordSend(bucket, request.op)
+                    self.recordWait(bucket, time.perf_counter() - request.queued_at)
+                    metrics.increment('discord_requests_total', op=request.op, source=request.source)
+                    try: result = await request.func()
+                    except Exception as e:
+                        if not request.future.done(): request.future.set_exception(e)
+                    else:
+                        if not request.future.done(): request.future.set_result(result)
+        finally:
+            del self.workers[bucket]
+            del self.queues[bucket]
+            if bucket in self.sent: self.forgetSends(bucket)
+
+    def nextRequest(self, bucket, queue):
+        # Index in the queue of the first request in priority order whose
+        # operation is not held back by its rate limit. None and the seconds
+        # until one is free if all are.
+        if self.rateLimitDelay(bucket, queue[0][2].op) <= 0: return 0, 0
+        delays = {}
+        best = None
+        for index, (priority, sequence, request) in enumerate(queue):
+            if request.op not in delays: delays[request.op] = self.rateLimitDelay(bucket, request.op)
+            if delays[request.op] > 0: continue
+            if best == None or (priority, sequence) < queue[best][:2]: best = index
+        if best == None: return None, min(delays.values())
+        return best, 0
+
+    def rateLimitDelay(self, bucket, op):
+        # Seconds until a request of op may be sent in the bucket.
+        if self.rate_limit == None or op not in PACED_OPS: return 0
+        sent = self.sent.get(bucket, {}).get(op)
+        limit, window = self.rate_limit
+        if sent == None or len(sent) < limit: return 0
+        return sent[0] + window - time.perf_counter()
+
+    def recordSend(self, bucket, op):
+        if self.rate_limit == None or op not in PACED_OPS: return
+        sent = self.sent.setdefault(bucket, {}).setdefault(op, collections.deque(maxlen=self.rate_limit[0]))
+        sent.append(time.perf_counter())
+
+    def forgetSends(self, bucket):
+        # Send times are kept until the window after the bucket's last
+        # request has passed.
+        if bucket in self.workers or bucket not in self.sent: return
+        window = self.rate_limit[1] if self.rate_limit != None else 0
+        last = max(sent[-1] for sent in self.sent[bucket].values())
+        if last + window <= time.perf_counter(): del self.sent[bucket]
+        else: asyncio.get_event_loop().call_later(last + window - time.perf_counter(), self.forgetSends, bucket)
+
+    def recordWait(self, bucket, wait):
+        metrics.observe('dispatch_wait_seconds', wait)
+        stats = self.bucket_stats.pop(bucket, None) or [0, 0.0, 0.0]
+        self.bucket_stats[bucket] = stats
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+        if len(self.bucket_stats) > BUCKET_STATS_LIMIT: del self.bucket_stats[next(iter(self.bucket_stats))]
+
+    def slowestBuckets(self, count=SLOWEST_BUCKETS):
+        # [(bucket, requests, average wait, max wait)] with the highest
+        # average wait first.
+        buckets = [(bucket, requests, total / requests, max_wait)
+            for bucket, [requests, total, max_wait] in self.bucket_stats.items()]
+        return sorted(buckets, key=lambda stats: stats[2], reverse=True)[:count]
+
+    def bucketWaitGauges(self):
+        gauges = []
+        for bucket, _, average, max_wait in self.slowestBuckets():
+            gauges.append(({'bucket': bucket, 'stat': 'avg'}, average))
+            gauges.append(({'bucket': bucket, 'stat': 'max'}, max_wait))
+        return gauges
+
+dispatcher = Dispatcher()
+metrics.registerGauge('dispatch_bucket_wait_seconds', dispatcher.bucketWaitGauges)
@@ -0,0 +1,594 @@
+import sys
+import types
+import asyncio
+import random
+import itertools
+import time
+from collections import Counter
+
+# In-process stand-in for the parts of discord.py the bot uses. Calls that
+# would be REST requests go through FakeBackend.request, which counts them
+# and simulates latency and per-channel rate limits (429s). Gateway events
+# are dispatched to the bot the same way discord.py does, one task per event.
+#
+# Usage: call install() before importing lobby or SuperLobbyBot, then drive
+# the bot through FakeBackend.
+
+DISCORD_EPOCH = 1420070400000
+# Ids carry their creation time like Discord's, all of them read as created
+# when the fake was imported.
+snowflakes = itertools.count((int(time.time() * 1000) - DISCORD_EPOCH) << 22)
+
+class HTTPException(Exception):
+    def __init__(self, status, text=''):
+        super(HTTPException, self).__init__(f'{status} {text}')
+        self.status = status
+        self.text = text
+
+class Forbidden(HTTPException):
+    def __init__(self, text='Missing Permissions'):
+        super(Forbidden, self).__init__(403, text)
+
+class NotFound(HTTPException):
+    def __init__(self, text='Unknown Message'):
+        super(NotFound, self).__init__(404, text)
+
+class FakeBackend():
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=None, seed=0):
+        # rate_limit: (requests, seconds) allowed per channel and operation,
+        # None for no limit.
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.in_flight = 0
+        self.rate_limited = Counter()
+        self.buckets = {} # (channel_id, op) -> [window start, requests in window]
+        self.guilds = {}
+        self.channels = {}
+        self.messages = {}
+        self.users = {}
+        self.bot = None
+        self.edit_listeners = []
+        self.manage_messages = True # Whether the bot has Manage Messages in new channels
+        self.connected = True # Events are only delivered while connected
+        self.interactions = {} # interaction id -> [message, time of the press]
+        self.late_interactions = 0 # Answered after Discord's 3 second limit
+        self.failures = Counter() # op -> number of its next calls that fail with a 503
+
+    def totalCalls(self):
+        return sum(self.calls.values())
+
+    async def request(self, op, channel_id=None):
+        # Behaves like discord.py: a 429 is waited out and retried, so the
+        # caller only sees the extra delay.
+        while True:
+            self.calls[op] += 1
+            retry_after = self.checkRateLimit((channel_id, op))
+            if retry_after == 0: break
+            self.rate_limited[op] += 1
+            await asyncio.sleep(retry_after)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        self.in_flight += 1
+        try:
+            if delay > 0: await asyncio.sleep(delay)
+            else: await asyncio.sleep(0)
+        finally: self.in_flight -= 1
+        if self.failures[op] > 0:
+            self.failures[op] -= 1
+            raise HTTPException(503, 'Service Unavailable')
+
+    def checkRateLimit(self, bucket_key):
+        if self.rate_limit == None or bucket_key[0] == None: return 0
+        limit, window = self.rate_limit
+        now = time.perf_counter()
+        bucket = self.buckets.setdefault(bucket_key, [now, 0])
+        if now - bucket[0] >= window:
+            bucket[0] = now
+            bucket[1] = 0
+        if bucket[1] >= limit: return window - (now - bucket[0])
+        bucket[1] += 1
+        return 0
+
+    def createGuild(self, name=''):
+        guild = FakeGuild(self, next(snowflakes), name)
+        self.guilds[guild.id] = guild
+        return guild
+
+    def createChannel(self, guild, name=''):
+        channel = FakeChannel(self, next(snowflakes), guild, name)
+        channel.manage_messages = self.manage_messages
+        self.channels[channel.id] = channel
+        guild.channels.append(channel)
+        return channel
+
+    def createUser(self, name='', bot=False):
+        user = FakeUser(next(snowflakes), name, bot)
+        self.users[user.id] = user
+        return user
+
+    def getMessage(self, message_id):
+        if message_id not in self.messages: raise NotFound()
+        return self.messages[message_id]
+
+    def dispatch(self, event, *args):
+        if self.bot != None and self.connected: self.bot.dispatch(event, *args)
+
+    def disconnect(self):
+        # Drops the gateway connection, events are lost until resume().
+        self.connected = False
+
+    def resume(self):
+        self.connected = True
+        self.dispatch('resumed')
+
+    # User actions, these are not requests made by the bot.
+
+    def react(self, user, message, emoji='✅'):
+        if message.addReactionUser(emoji, user):
+            member = FakeMember(user, message.channel.guild)
+            self.dispatch('raw_reaction_add', FakeRawReactionEvent(message, user, emoji, member=member))
+
+    def press(self, user, message, custom_id):
+        # Presses a button on the message, like the raw INTERACTION_CREATE
+        # gateway event.
+        interaction_id = str(next(snowflakes))
+        self.interactions[interaction_id] = [message, time.perf_counter()]
+        self.dispatch('socket_response', {'op': 0, 't': 'INTERACTION_CREATE', 'd': {
+            'id': interaction_id, 'token': f'token{interaction_id}', 'type': 3,
+            'data': {'custom_id': custom_id, 'component_type': 2},
+            'message': {'id': str(message.id)}, 'channel_id': str(message.channel.id),
+            'member': {'user': {'id': str(user.id)}},
+            }})
+
+    def unreact(self, user, message, emoji='✅'):
+        if message.removeReactionUser(emoji, user):
+            self.dispatch('raw_reaction_remove', FakeRawReactionEvent(message, user, emoji))
+
+    async def invoke(self, command_name, channel, author, *args):
+        # Runs a bot command like a user typing it in the channel.
+        command_message = channel.storeMessage(author, f'!{command_name}')
+        context = FakeContext(self, command_message)
+        return await self.bot.invokeCommand(command_name, context, *args)
+
+class FakeGuild():
+    def __init__(self, backend, guild_id, name):
+        self.backend = backend
+        self.id = guild_id
+        self.name = name
+        self.channels = []
+
+    @property
+    def me(self):
+        if self.backend.bot == None: return None
+        return FakeMember(self.backend.bot.user, self)
+
+class FakeUser():
+    def __init__(self, user_id, name='', bot=False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+class FakeMember(FakeUser):
+    # discord.py builds a new Member for every event and every page of
+    # reaction users, so these are not shared like FakeUser.
+    def __init__(self, user, guild):
+        super(FakeMember, self).__init__(user.id, user.name, user.bot)
+        self.guild = guild
+        self.nick = None
+        self.roles = []
+        self.joined_at = None
+
+class Object():
+    def __init__(self, id):
+        self.id = id
+
+class Intents():
+    # Only records the flags that are set, the fake delivers every event.
+    @classmethod
+    def none(cls):
+        return cls()
+
+class MemberCacheFlags():
+    @classmethod
+    def none(cls):
+        return cls()
+
+class Permissions():
+    def __init__(self, manage_messages=False):
+        self.manage_messages = manage_messages
+
+class FakeChannel():
+    def __init__(self, backend, channel_id, guild, name):
+        self.backend = backend
+        self.id = channel_id
+        self.guild = guild
+        self.name = name
+        self.manage_messages = True
+
+    def permissions_for(self, member):
+        # Only the bot's permissions are modelled.
+        return Permissions(manage_messages=self.manage_messages and member.id == self.backend.bot.user.id)
+
+    def storeMessage(self, author, content):
+        message = Message(self, next(snowflakes), author, content)
+        self.backend.messages[message.id] = message
+        return message
+
+    async def send(self, content):
+        await self.backend.request('send', self.id)
+        return self.storeMessage(self.backend.bot.user, content)
+
+    async def fetch_message(self, message_id):
+        await self.backend.request('fetch_message', self.id)
+        message = self.backend.getMessage(message_id)
+        if message.channel is not self: raise NotFound()
+        return message
+
+    def get_partial_message(self, message_id):
+        return PartialMessage(channel=self, id=message_id)
+
+class Reaction():
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+        self.user_ids = []
+
+    @property
+    def count(self):
+        return len(self.user_ids)
+
+    @property
+    def me(self):
+        return self.message.channel.backend.bot.user.id in self.user_ids
+
+    async def users(self, limit=None):
+        # Paged 100 users per request like the real endpoint.
+        backend = self.message.channel.backend
+        user_ids = list(self.user_ids)
+        for start in range(0, max(len(user_ids), 1), 100):
+            await backend.request('reaction_users', self.message.channel.id)
+            for user_id in user_ids[start:start+100]:
+                yield FakeMember(backend.users[user_id], self.message.channel.guild)
+
+class Message():
+    def __init__(self, channel, message_id, author, content):
+        self.channel = channel
+        self.id = message_id
+        self.author = author
+        self.content = content
+        self.reactions = []
+        self.deleted = False
+        self.components = []
+
+    @property
+    def guild(self):
+        return self.channel.guild
+
+    def getReaction(self, emoji):
+        for reaction in self.reactions:
+            if str(reaction.emoji) == str(emoji): return reaction
+        return None
+
+    def addReactionUser(self, emoji, user):
+        reaction = self.getReaction(emoji)
+        if reaction == None:
+            reaction = Reaction(self, emoji)
+            self.reactions.append(reaction)
+        if user.id in reaction.user_ids: return False
+        reaction.user_ids.append(user.id)
+        return True
+
+    def removeReactionUser(self, emoji, user):
+        reaction = self.getReaction(emoji)
+        if reaction == None or user.id not in reaction.user_ids: return False
+        reaction.user_ids.remove(user.id)
+        if reaction.count == 0: self.reactions.remove(reaction)
+        return True
+
+    async def edit(self, content=None, **kwargs):
+        backend = self.channel.backend
+        await backend.request('edit', self.channel.id)
+        if self.deleted: raise NotFound()
+        if content != None: self.content = content
+        for listener in backend.edit_listeners: listener(self, time.perf_counter())
+
+    async def delete(self):
+        backend = self.channel.backend
+        await backend.request('delete', self.channel.id)
+        if self.deleted: raise NotFound()
+        self.deleted = True
+        del backend.messages[self.id]
+        backend.dispatch('raw_message_delete', FakeRawMessageDeleteEvent(self))
+
+    async def add_reaction(self, emoji):
+        backend = self.channel.backend
+        await backend.request('add_reaction', self.channel.id)
+        if self.deleted: raise NotFound()
+        backend.react(backend.bot.user, self, emoji)
+
+    async def remove_reaction(self, emoji, member):
+        backend = self.channel.backend
+        await backend.request('remove_reaction', self.channel.id)
+        if self.deleted: raise NotFound()
+        if member.id != backend.bot.user.id and not self.channel.manage_messages: raise Forbidden()
+        backend.unreact(backend.users[member.id], self, emoji)
+
+    async def clear_reactions(self):
+        backend = self.channel.backend
+        await backend.request('clear_reactions', self.channel.id)
+        if self.deleted: raise NotFound()
+        if not self.channel.manage_messages: raise Forbidden()
+        self.reactions = []
+        backend.dispatch('raw_reaction_clear', FakeRawReactionClearEvent(self))
+
+    async def clear_reaction(self, emoji):
+        backend = self.channel.backend
+        await backend.request('clear_reaction', self.channel.id)
+        if self.deleted: raise NotFound()
+        if not self.channel.manage_messages: raise Forbidden()
+        reaction = self.getReaction(emoji)
+        if reaction == None: return
+        self.reactions.remove(reaction)
+        backend.dispatch('raw_reaction_clear_emoji', FakeRawReactionClearEvent(self, emoji))
+
+    async def fetch(self):
+        return await self.channel.fetch_message(self.id)
+
+class PartialMessage():
+    # Only holds ids, everything is looked up when a request is made.
+    def __init__(self, channel, id):
+        self.channel = channel
+        self.id = id
+
+    def resolve(self):
+        message = self.channel.backend.messages.get(self.id)
+        if message == None or message.deleted: raise NotFound()
+        return message
+
+    async def edit(self, content=None, **kwargs):
+        backend = self.channel.backend
+        if self.id not in backend.messages:
+            await backend.request('edit', self.channel.id)
+            raise NotFound()
+        await backend.messages[self.id].edit(content=content, **kwargs)
+
+    async def delete(self):
+        backend = self.channel.backend
+        if self.id not in backend.messages:
+            await backend.request('delete', self.channel.id)
+            raise NotFound()
+        await backend.messages[self.id].delete()
+
+    async def add_reaction(self, emoji):
+        await self.resolve().add_reaction(emoji)
+
+    async def remove_reaction(self, emoji, member):
+        await self.resolve().remove_reaction(emoji, member)
+
+    async def clear_reactions(self):
+        await self.resolve().clear_reactions()
+
+    async def clear_reaction(self, emoji):
+        await self.resolve().clear_reaction(emoji)
+
+    async def fetch(self):
+        return await self.channel.fetch_message(self.id)
+
+class Route():
+    def __init__(self, method, path, **parameters):
+        self.method = method
+        self.path = path
+        self.parameters = parameters
+
+class FakeHTTP():
+    # bot.http, only the raw routes the bot requests.
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def request(self, route, json=None, **kwargs):
+        backend = self.backend
+        if route.method == 'POST' and route.path == '/channels/{channel_id}/messages':
+            channel = backend.channels[route.parameters['channel_id']]
+            await backend.request('send', channel.id)
+            message = channel.storeMessage(backend.bot.user, json['content'])
+            message.components = json.get('components', [])
+            return {'id': str(message.id), 'channel_id': str(channel.id)}
+        if route.method == 'PATCH' and route.path == '/channels/{channel_id}/messages/{message_id}':
+            await backend.request('edit', route.parameters['channel_id'])
+            message = backend.messages.get(route.parameters['message_id'])
+            if message == None or message.channel.id != route.parameters['channel_id']: raise NotFound()
+            message.content = json['content']
+            message.components = json['components']
+            for listener in backend.edit_listeners: listener(message, time.perf_counter())
+            return {'id': str(message.id), 'channel_id': str(message.channel.id)}
+        if route.method == 'POST' and route.path == '/interactions/{interaction_id}/{interaction_token}/callback':
+            await backend.request('interaction_callback')
+            message, pressed_at = backend.interactions.pop(route.parameters['interaction_id'])
+            now = time.perf_counter()
+            if now - pressed_at > 3: backend.late_interactions += 1
+            if json['type'] == 7:
+                message.content = json['data']['content']
+                for listener in backend.edit_listeners: listener(message, now)
+            return None
+        raise NotFound()
+
+class FakeRawReactionEvent():
+    def __init__(self, message, user, emoji, member=None):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.channel.guild.id
+        self.user_id = user.id
+        self.emoji = emoji
+        self.member = member
+
+class FakeRawReactionClearEvent():
+    # RawReactionClearEvent, or RawReactionClearEmojiEvent when emoji is set.
+    def __init__(self, message, emoji=None):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.channel.guild.id
+        self.emoji = emoji
+
+class FakeRawMessageDeleteEvent():
+    def __init__(self, message):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.channel.guild.id
+
+class FakeContext():
+    def __init__(self, backend, message):
+        self.backend = backend
+        self.message = message
+        self.channel = message.channel
+        self.guild = message.channel.guild
+        self.author = message.author
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+class CommandError(Exception): pass
+class MissingRequiredArgument(CommandError): pass
+class BadArgument(CommandError): pass
+class MissingPermissions(CommandError): pass
+class NotOwner(CommandError): pass
+
+class CommandInvokeError(CommandError):
+    def __init__(self, original):
+        super(CommandInvokeError, self).__init__(str(original))
+        self.original = original
+
+class Command():
+    def __init__(self, callback, name):
+        self.callback = callback
+        self.name = name
+        self.on_error = None
+        self.checks = getattr(callback, '__commands_checks__', [])
+
+    def error(self, func):
+        self.on_error = func
+        return func
+
+class Bot():
+    def __init__(self, command_prefix='!', **options):
+        self.command_prefix = command_prefix
+        self.options = options
+        self.loop = asyncio.get_event_loop()
+        self.backend = None
+        self.user = None
+        self.owner_id = None
+        self.all_commands = {}
+        self.events = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def attach(self, backend, user_id):
+        # Connects the bot to a fake backend, like logging in.
+        backend.bot = self
+        self.backend = backend
+        self.user = FakeUser(user_id, 'bot', True)
+        self.http = FakeHTTP(backend)
+        backend.users[user_id] = self.user
+
+    def setReady(self):
+        self.ready.set()
+
+    async def wait_until_ready(self):
+        await self.ready.wait()
+
+    def is_closed(self):
+        return self.closed
+
+    def command(self, name=None, **kwargs):
+        def decorator(func):
+            command = Command(func, name or func.__name__)
+            self.all_commands[command.name] = command
+            return command
+        return decorator
+
+    def event(self, func):
+        self.events[func.__name__] = func
+        return func
+
+    def dispatch(self, event, *args):
+        handler = self.events.get(f'on_{event}')
+        if handler != None: asyncio.ensure_future(handler(*args))
+
+    async def invokeCommand(self, name, context, *args):
+        command = self.all_commands[name]
+        try:
+            for check in command.checks:
+                if not check(context): raise NotOwner()
+            try: return await command.callback(context, *args)
+            except CommandError: raise
+            except Exception as e: raise CommandInvokeError(e)
+        except CommandError as error:
+            if command.on_error == None: raise
+            try: await command.on_error(context, error)
+            except: pass
+
+    def get_channel(self, channel_id):
+        return self.backend.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id):
+        await self.backend.request('fetch_channel')
+        if channel_id not in self.backend.channels: raise NotFound('Unknown Channel')
+        return self.backend.channels[channel_id]
+
+    def get_user(self, user_id):
+        return self.backend.users.get(user_id)
+
+    def run(self, token):
+        raise RuntimeError('The fake bot is driven by the benchmark, not run.')
+
+def is_owner():
+    def decorator(func):
+        checks = getattr(func, '__commands_checks__', [])
+        checks.append(lambda context: context.author.id == context.backend.bot.owner_id)
+        func.__commands_checks__ = checks
+        return func
+    return decorator
+
+def install():
+    # Registers the fake as the discord package. Must run before anything
+    # imports discord.
+    discord = types.ModuleType('discord')
+    errors = types.ModuleType('discord.errors')
+    http = types.ModuleType('discord.http')
+    utils = types.ModuleType('discord.utils')
+    ext = types.ModuleType('discord.ext')
+    commands = types.ModuleType('discord.ext.commands')
+
+    for cls in [HTTPException, Forbidden, NotFound]:
+        setattr(errors, cls.__name__, cls)
+        setattr(discord, cls.__name__, cls)
+    discord.errors = errors
+    http.Route = Route
+    discord.http = http
+    utils.DISCORD_EPOCH = DISCORD_EPOCH
+    discord.utils = utils
+    discord.Object = Object
+    discord.Message = Message
+    discord.PartialMessage = PartialMessage
+    discord.Intents = Intents
+    discord.MemberCacheFlags = MemberCacheFlags
+    discord.ext = ext
+    ext.commands = commands
+
+    commands.Bot = Bot
+    commands.AutoShardedBot = Bot
+    commands.is_owner = is_owner
+    for cls in [CommandError, CommandInvokeError, MissingRequiredArgument, BadArgument, MissingPermissions, NotOwner]:
+        setattr(commands, cls.__name__, cls)
+
+    sys.modules['discord'] = discord
+    sys.modules['discord.errors'] = errors
+    sys.modules['discord.http'] = http
+    sys.modules['discord.utils'] = utils
+    sys.modules['discord.ext'] = ext
+    sys.modules['discord.ext.commands'] = commands
@@ -0,0 +1,49 @@
+import os
+import asyncio
+import contextvars
+
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 8)) # Max concurrent requests per fan-out
+
+async def fanOut(func, items, limit=FANOUT_CONCURRENCY):
+    # Runs func(item) for every value in the items dict with at most {limit}
+    # calls in flight. Returns two dicts keyed like items: results of the calls
+    # that succeeded and the exceptions of the ones that failed.
+    semaphore = asyncio.Semaphore(limit)
+    results = {}
+    errors = {}
+
+    async def run(key, item):
+        async with semaphore:
+            try: results[key] = await func(item)
+            except Exception as e: errors[key] = e
+
+    await asyncio.gather(*[run(key, item) for key, item in items.items()])
+    return results, errors
+
+async def waitRequests(futures):
+    # Waits for the futures of requests submitted to the dispatcher, a dict
+    # like the items of fanOut. A cancelled caller leaves the requests
+    # queued, they may be shared with other callers. Returns results and
+    # errors like fanOut.
+    pending = set(futures.values())
+    if len(pending) > 0:
+        done = asyncio.get_event_loop().create_future()
+        def completed(future):
+            pending.discard(future)
+            if len(pending) == 0 and not done.done(): done.set_result(None)
+        # One context for all the callbacks, add_done_callback copies the
+        # current one for each otherwise.
+        context = contextvars.copy_context()
+        for future in pending: future.add_done_callback(completed, context=context)
+        await done
+    results = {}
+    errors = {}
+    for key, future in futures.items():
+        if future.exception() != None: errors[key] = future.exception()
+        else: results[key] = future.result()
+    return results, errors
+
+def reportErrors(name, errors, total):
+    if len(errors) == 0: return
+    reasons = ', '.join(sorted(set(type(e).__name__ for e in errors.values())))
+    print(f'{name}: {len(errors)}/{total} clones failed ({reasons})')
@@ -0,0 +1,74 @@
+from discord.http import Route
+
+import metrics
+
+# Join/Leave buttons for lobbies in button mode. discord.py 1.x has no
+# support for message components, so the buttons are sent with raw API
+# requests and presses are read from the raw INTERACTION_CREATE gateway
+# event.
+
+JOIN_ID = 'lobby_join'
+LEAVE_ID = 'lobby_leave'
+DEADLINE = 2 # Seconds before a press is acknowledged without an update, Discord waits 3
+
+# Interaction callback types
+CHANNEL_MESSAGE = 4
+DEFERRED_UPDATE_MESSAGE = 6
+UPDATE_MESSAGE = 7
+EPHEMERAL = 64 # Message flag, only shown to the user who pressed
+
+class APIRoute(Route):
+    # Components need a newer API version than discord.py 1.x uses.
+    BASE = 'https://discord.com/api/v9'
+
+def components():
+    return [{'type': 1, 'components': [
+        {'type': 2, 'style': 3, 'label': 'Join', 'custom_id': JOIN_ID},
+        {'type': 2, 'style': 4, 'label': 'Leave', 'custom_id': LEAVE_ID},
+        ]}]
+
+async def sendMessage(bot, channel_id, content):
+    # Posts a message with the buttons. Returns the message id.
+    data = await bot.http.request(APIRoute('POST', '/channels/{channel_id}/messages', channel_id=channel_id),
+        json={'content': content, 'components': components()})
+    return int(data['id'])
+
+async def editMessage(bot, channel_id, message_id, content, components):
+    # Edits a message and its buttons, components=[] removes them.
+    await bot.http.request(APIRoute('PATCH', '/channels/{channel_id}/messages/{message_id}',
+        channel_id=channel_id, message_id=message_id), json={'content': content, 'components': components})
+
+class Interaction():
+    # A press of a lobby button.
+    __slots__ = ('id', 'token', 'custom_id', 'message_id', 'channel_id', 'user_id', 'outcome')
+
+    def __init__(self, id, token, custom_id, message_id, channel_id, user_id):
+        self.id = id
+        self.token = token
+        self.custom_id = custom_id
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.outcome = None # Set when the press is applied, see SuperLobbyBot.op_interaction
+
+    @classmethod
+    def fromEvent(cls, event):
+        # None unless the gateway event is a press of a lobby button.
+        if event.get('t') != 'INTERACTION_CREATE': return None
+        data = event['d']
+        custom_id = data.get('data', {}).get('custom_id')
+        if custom_id not in [JOIN_ID, LEAVE_ID] or 'message' not in data: return None
+        user = data['member']['user'] if 'member' in data else data['user']
+        return cls(data['id'], data['token'], custom_id, int(data['message']['id']), int(data['channel_id']),
+            int(user['id']))
+
+    def getData(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'outcome'}
+
+    async def respond(self, bot, response_type, data=None):
+        # Every interaction is answered once, within 3 seconds of the press.
+        payload = {'type': response_type}
+        if data != None: payload['data'] = data
+        metrics.increment('discord_requests_total', op='interaction_callback', source=metrics.current_source.get())
+        await bot.http.request(APIRoute('POST', '/interactions/{interaction_id}/{interaction_token}/callback',
+            interaction_id=self.id, interaction_token=self.token), json=payload)
@@ -1,7 +1,9 @@
 import os
+import sys
 import random
 import secrets
 import asyncio
+import functools
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -9,23 +11,64 @@ import time
 import math
 import json
 
+from fanout import fanOut, waitRequests, reportErrors
+import reactions
+import interactions
+import admission
+from scheduler import DeadlineHeap, Mailbox
+import metrics
+from dispatcher import dispatcher, PRIORITY_NOTIFY, PRIORITY_RENDER, PRIORITY_RECONCILE
+
 load_dotenv()
 BOT_ID = int(os.getenv('BOT_ID'))
+RENDER_DELAY = float(os.getenv('LOBBY_RENDER_DELAY', 2)) # Seconds to collect changes before editing messages
+MESSAGE_LIMIT = 2000 # Discord's maximum message length
+MODE_REACTIONS = 'reactions' # Members join by reacting to a clone
+MODE_BUTTONS = 'buttons' # Members join and leave with buttons on the clones
+
+def addEmoji(user_reactions, message_id, emoji):
+    # Emojis are kept as interned strings in tuples, nearly every user has a
+    # single reaction and a tuple is a fraction of the size of a set.
+    emojis = user_reactions.get(message_id, ())
+    emoji = sys.intern(str(emoji))
+    if emoji not in emojis: user_reactions[message_id] = emojis + (emoji,)
+
+def messageRefs(messages):
+    # fanOut items for a message_id -> channel_id dict.
+    return {message_id: (message_id, channel_id) for message_id, channel_id in messages.items()}
+
+async def pageUsers(reaction):
+    # Users of a reaction other than the bot, Discord pages them 100 at a time.
+    return [user.id async for user in reaction.users() if user.id != BOT_ID]
 
 class Lobby():
+    # Only ids are kept, Discord objects are created when a request is made
+    # and dropped again afterwards.
+    __slots__ = ('author_id', 'size', 'name', 'bot', 'mailbox', 'render_task', 'hash', 'messages',
+        'message_content', 'channel_guilds', 'members', 'member_reactions', 'left_reactions', 'member_expiry', 'finalized', 'allow_cloning',
+        'creation_time', 'timeout', 'user_timeout', 'last_activity', 'version', 'render_cache',
+        'shard', 'mode', 'saved_activity')
+    title = 'Lobby'
+    member_index = None # Told about every join and leave, the bot sets this to its LobbyRegistry
+    mailbox_handler = None # Applies a batch of mailbox operations as handler(lobby, batch), set by the bot
+
     def __init__(self, size, name, author_id, lobby_timeout, user_timeout, bot):
         self.author_id = author_id
         self.size = size
         self.name = f' - {name}' if name != "" else ""
         self.bot = bot
 
-        self.update_lock = asyncio.Lock()
+        self.mailbox = Mailbox()
+        self.render_task = None
 
         self.hash = secrets.token_hex(4)
-        self.messages = {}
-        self.members = {}
-        self.members_last_active = {}
-        self.members_timeout = {}
+        self.messages = {} # message_id -> channel_id
+        self.message_content = {} # message_id -> last content submitted for the clone
+        self.channel_guilds = {} # channel_id -> guild_id of the channels with clones
+        self.members = {} # user_id -> last active time, in join order
+        self.member_reactions = {} # user_id -> {message_id: tuple of emoji strings}
+        self.left_reactions = {} # message_id -> {emoji: set of user_ids} of removed members whose reactions could not be removed
+        self.member_expiry = DeadlineHeap() # user_id keyed on last active time
         self.finalized = False
 
         self.allow_cloning = True
@@ -34,26 +77,40 @@ class Lobby():
         self.timeout = lobby_timeout
         self.user_timeout = user_timeout
         self.last_activity = self.creation_time
+        self.version = 0 # Incremented on every change shown in the lobby messages
+        self.render_cache = (None, None) # (render key, lobby string)
+        self.shard = 0 # Shard owning the lobby
+        self.mode = MODE_REACTIONS
+        self.saved_activity = {} # user_id -> last active time of saved members without tracked reactions
 
 
     def getSaveData(self):
         data = {
             'type': 'Lobby',
             'hash': self.hash,
+            'shard': self.shard,
+            'mode': self.mode,
             'author_id': self.author_id,
             'size': self.size,
             'name': self.name,
-            'messages': [[message.id, message.channel.id] for message in self.messages.values()],
+            'messages': [[message_id, channel_id] for message_id, channel_id in self.messages.items()],
+            'channel_guilds': self.channel_guilds,
             'creation_time': self.creation_time,
             'timeout': self.timeout,
             'user_timeout': self.user_timeout,
-            'members_last_active': self.members_last_active,
+            'members_last_active': self.members,
+            'member_reactions': {user_id: {message_id: list(emojis) for message_id, emojis in user_reactions.items()}
+                for user_id, user_reactions in self.member_reactions.items()},
+            'left_reactions': {message_id: {emoji: list(user_ids) for emoji, user_ids in message_left.items()}
+                for message_id, message_left in self.left_reactions.items()},
             'last_activity': self.last_activity
             }
         return data
     
-    async def loadData(self, data):
+    def loadData(self, data):
         self.hash = data['hash']
+        self.shard = data.get('shard', 0)
+        self.mode = data.get('mode', MODE_REACTIONS)
         self.author_id = data['author_id']
         self.size = data['size']
         self.name = data['name']
@@ -61,38 +118,107 @@ class Lobby():
         self.timeout = data['timeout']
         self.user_timeout = data['user_timeout']
         self.last_activity = data['last_activity']
-        self.members_last_active = data['members_last_active']
-        messages = {}
-        for [message_id, channel_id] in data['messages']:
-            try:
-                channel = await self.bot.fetch_channel(channel_id)
-                message = await channel.fetch_message(message_id)
-                messages[message_id] = message
-            except: pass
-        self.messages = messages
+        # JSON object keys are strings, user ids are ints.
+        members_last_active = {int(user_id): t for user_id, t in data['members_last_active'].items()}
+        self.member_reactions = {int(user_id): {int(message_id): tuple(sys.intern(emoji) for emoji in emojis)
+            for message_id, emojis in user_reactions.items()}
+            for user_id, user_reactions in data.get('member_reactions', {}).items()}
+        self.left_reactions = {int(message_id): {sys.intern(emoji): set(user_ids) for emoji, user_ids in message_left.items()}
+            for message_id, message_left in data.get('left_reactions', {}).items()}
+        self.members = {}
+        for user_id in self.member_reactions:
+            self.setMemberActive(user_id, members_last_active.pop(user_id, self.last_activity))
+        # Saves from before member_reactions was kept have members only, they
+        # keep their times when fetchMembers finds their reactions.
+        self.saved_activity = members_last_active
+        self.messages = {message_id: channel_id for [message_id, channel_id] in data['messages']}
+        self.channel_guilds = {int(channel_id): guild_id for channel_id, guild_id in data.get('channel_guilds', {}).items()}
+
+    def resolveGuilds(self):
+        # Fills in guilds missing from older saves from the channel cache.
+        for channel_id in self.messages.values():
+            channel = self.bot.get_channel(channel_id)
+            if channel_id in self.channel_guilds or getattr(channel, 'guild', None) == None: continue
+            self.channel_guilds[channel_id] = channel.guild.id
+
+    def post(self, op, *args):
+        # Queues op(lobby, *args) for the lobby's worker. All changes to a
+        # live lobby go through here, returns a future for the result.
+        return self.mailbox.post(self.mailbox_handler, op, *args)
 
+    def request(self, channel_id, priority, func, key=None, op='request'):
+        # Sends a request through the dispatcher. Shielded so a cancelled
+        # caller does not cancel a request it shares with a superseding one.
+        return asyncio.shield(dispatcher.submit(channel_id, priority, func, key, op))
+
+    async def getChannel(self, channel_id, priority=PRIORITY_RECONCILE):
+        # No request is needed when the channel is cached.
+        channel = self.bot.get_channel(channel_id)
+        if channel == None:
+            channel = await self.request(channel_id, priority, lambda: self.bot.fetch_channel(channel_id),
+                'fetch_channel', 'fetch_channel')
+        return channel
+
+    async def getChannels(self, channel_ids, priority=PRIORITY_RECONCILE):
+        # channel_id -> channel of the channels that could be resolved and
+        # the errors of the others. Only uncached channels are fetched.
+        channels = {channel_id: self.bot.get_channel(channel_id) for channel_id in channel_ids}
+        missing = {channel_id: channel_id for channel_id, channel in channels.items() if channel == None}
+        fetched, errors = await fanOut(lambda channel_id: self.getChannel(channel_id, priority), missing)
+        channels.update(fetched)
+        return {channel_id: channel for channel_id, channel in channels.items() if channel != None}, errors
+
+    async def messageRequest(self, message_id, channel_id, priority, func, key=None, op='request'):
+        # Like request, func(message) is called with a partial message of the
+        # clone. The channel is resolved before the request is queued, a
+        # request of the bucket must not wait for another one.
+        channel = await self.getChannel(channel_id, priority)
+        return await self.request(channel_id, priority, lambda: func(channel.get_partial_message(message_id)), key, op)
 
 
     def isTimedOut(self):
         if self.timeout < 0: return False
         return time.time() - self.creation_time > self.timeout
     
-    def timeRemaining(self):
-        t = time.time() - self.creation_time
-        t = math.floor((self.timeout - t) / 60.0) 
-        t = max(0, t)
-        return t
+    def nextDeadline(self, inactivity_timeout):
+        # Earliest time at which something about this lobby needs checking:
+        # lobby timeout, inactivity timeout or a member reaction timeout.
+        deadlines = [self.last_activity + inactivity_timeout]
+        if self.timeout >= 0: deadlines.append(self.creation_time + self.timeout)
+        last_active = self.member_expiry.nextDeadline()
+        if self.user_timeout >= 0 and last_active != None:
+            deadlines.append(last_active + self.user_timeout)
+        return min(deadlines)
+
+    def closingTime(self):
+        # Unix time the lobby times out, None without a lobby timer.
+        if self.timeout <= 0: return None
+        return math.floor(self.creation_time + self.timeout)
+
+    def changed(self):
+        self.version += 1
 
     def getLobbyString(self, add_mentions=True):
-        mention_str = '\n'.join([member.mention for member in self.members.values()])
+        # Rendered once per version, all clones share the string.
+        render_key = (self.version, self.closingTime(), add_mentions)
+        if self.render_cache[0] == render_key: return self.render_cache[1]
+        msg = self.renderLobbyString(add_mentions)
+        self.render_cache = (render_key, msg)
+        return msg
+
+    def renderLobbyString(self, add_mentions):
+        mention_str = '\n'.join([f'<@{user_id}>' for user_id in self.members])
         if mention_str == '': mention_str = '...'
         if not add_mentions: mention_str = '...'
-        lobby_timeout_str = f'Lobby timer: `{self.timeRemaining()} min`.\n' if self.timeout>0 else ''
+        # Discord shows the timestamp as a countdown and keeps it current, the
+        # message is not edited for it.
+        lobby_timeout_str = f'Lobby timer: closes <t:{self.closingTime()}:R>.\n' if self.timeout>0 else ''
         reac_timeout_str = f'Reaction timeout: `{math.floor(self.user_timeout/60)} min`.\n' if self.user_timeout>0 else ''
+        join_str = 'Press Join to join lobby' if self.mode == MODE_BUTTONS else 'React to message to join lobby'
         msg = (
-            f'__**Lobby{self.name}**__\n'
+            f'__**{self.title}{self.name}**__\n'
             f'Mirror this lobby with: `!clonelobby {self.hash}`\n'
-            f'React to message to join lobby. Once `{self.size}` members are reached all members will be pinged.\n'
+            f'{join_str}. Once `{self.size}` members are reached all members will be pinged.\n'
             f'{lobby_timeout_str}'
             f'{reac_timeout_str}'
             f'**Members {len(self.members)}/{self.size}:**\n'
@@ -100,157 +226,420 @@ class Lobby():
         )
         return msg
     
-    def getNotificationString(self, users):
-        mention_str = ', '.join([user.mention for user in users.values()])
+    def getNotificationStrings(self, user_ids):
+        # The notification split into messages within MESSAGE_LIMIT, mentions
+        # are never split.
         name_str = f'**{self.name}**' if self.name != '' else ''
-        msg = (
-            f'Lobby {name_str} `{self.hash}` is now filled.\n'
-            f'{mention_str}'
-        )
-        return msg
+        chunks = [f'Lobby {name_str} `{self.hash}` is now filled.\n']
+        for user_id in user_ids:
+            mention = f'<@{user_id}>'
+            separator = '' if chunks[-1] == '' or chunks[-1].endswith('\n') else ', '
+            if len(chunks[-1]) + len(separator) + len(mention) > MESSAGE_LIMIT:
+                chunks.append('')
+                separator = ''
+            chunks[-1] += separator + mention
+        return chunks
 
+    @metrics.timed('lobby_operation_seconds', operation='fetchMessages')
     async def fetchMessages(self):
-        messages_updated = {}
-        for message_id in self.messages:
-            try:
-                msg = await self.messages[message_id].channel.fetch_message(message_id)
-                messages_updated[message_id] = msg
-            except: pass
-        self.messages = messages_updated
+        # Returns the full messages, they are not kept. Messages that are
+        # gone or no longer visible are dropped from the lobby. Other errors
+        # are taken as transient, those clones are kept as they are.
+        fetched, errors = await fanOut(
+            lambda message_ref: self.messageRequest(*message_ref, PRIORITY_RECONCILE,
+                lambda message: message.fetch(), ('fetch', message_ref[0]), 'fetch_message'),
+            messageRefs(self.messages))
+        reportErrors(f'Lobby {self.hash} fetchMessages', errors, len(self.messages))
+        for message_id, error in errors.items():
+            if isinstance(error, (discord.NotFound, discord.Forbidden)): self.forgetMessage(message_id)
+        # Only fills in clones without a known content, a fetch may complete
+        # while an edit of the clone is still queued.
+        for message_id, message in fetched.items():
+            self.message_content.setdefault(message_id, message.content)
+        return fetched
     
-    async def fetchMembers(self):
-        members_updated = {}
-        for message_id in self.messages:
-            for reaction in self.messages[message_id].reactions:
-                try:
-                    async for user in reaction.users():
-                        if user.id == BOT_ID: continue
-                        members_updated[user.id] = user
-                        if user.id not in self.members:
-                            self.members_last_active[user.id] = time.time()
-                except: pass
-        if members_updated != self.members:
-            self.members = members_updated
+    @metrics.timed('lobby_operation_seconds', operation='fetchMembers')
+    async def fetchMembers(self, messages):
+        # Rescan of the reactions on the messages from fetchMessages. Only
+        # used for reconciliation, regular membership changes are applied
+        # with addReaction/removeReaction. The users of a reaction are only
+        # paged when its count differs from the users tracked for it, a
+        # matching count is taken as nothing missed.
+        known = self.reactionsByMessage()
+        reactions_updated = {}
+        # Clones that could not be fetched keep their tracked reactions.
+        for message_id, message_known in known.items():
+            if message_id in messages or message_id not in self.messages: continue
+            for emoji, user_ids in message_known.items():
+                for user_id in user_ids: addEmoji(reactions_updated.setdefault(user_id, {}), message_id, emoji)
+        # Reactions left behind by removed members do not make them members
+        # again, they are forgotten once they are gone.
+        left_updated = {message_id: message_left for message_id, message_left in self.left_reactions.items()
+            if message_id not in messages and message_id in self.messages}
+        for message_id, message in messages.items():
+            message_known = known.get(message_id, {})
+            message_left = self.left_reactions.get(message_id, {})
+            for reaction in message.reactions:
+                emoji = str(reaction.emoji)
+                user_ids = message_known.get(emoji, set())
+                left_ids = message_left.get(emoji, set())
+                if reaction.count == len(user_ids) + len(left_ids) + (1 if reaction.me else 0):
+                    metrics.increment('reconcile_reactions_total', result='matched')
+                else:
+                    metrics.increment('reconcile_reactions_total', result='paged')
+                    try: paged_ids = await self.request(self.messages.get(message_id, message.channel.id), PRIORITY_RECONCILE,
+                        lambda: pageUsers(reaction), op='reaction_users')
+                    except: pass
+                    else:
+                        left_ids = left_ids.intersection(paged_ids)
+                        user_ids = [user_id for user_id in paged_ids if user_id not in left_ids]
+                for user_id in user_ids:
+                    addEmoji(reactions_updated.setdefault(user_id, {}), message_id, emoji)
+                if len(left_ids) > 0: left_updated.setdefault(message_id, {})[emoji] = left_ids
+        self.member_reactions = reactions_updated
+        self.left_reactions = left_updated
+        if reactions_updated.keys() != self.members.keys():
+            for user_id in list(self.members):
+                if user_id not in reactions_updated: self.removeMember(user_id)
+            for user_id in reactions_updated:
+                if user_id not in self.members: self.setMemberActive(user_id, self.saved_activity.get(user_id, time.time()))
             self.last_activity = time.time()
+            self.changed()
+        self.saved_activity = {}
+
+    def setMemberActive(self, user_id, t):
+        if user_id not in self.members and self.member_index != None: self.member_index.memberJoined(self, user_id)
+        self.members[user_id] = t
+        self.member_expiry.schedule(user_id, t)
+
+    def addReaction(self, message_id, user_id, emoji):
+        # Returns True if the user joined the lobby.
+        if user_id == BOT_ID: return False
+        self.dropLeftReaction(message_id, user_id, emoji)
+        user_reactions = self.member_reactions.setdefault(user_id, {})
+        addEmoji(user_reactions, message_id, emoji)
+        if user_id in self.members: return False
+        self.setMemberActive(user_id, time.time())
+        self.last_activity = time.time()
+        self.changed()
+        return True
+
+    def joinMember(self, message_id, user_id):
+        # Button mode. Returns True if the user joined the lobby, pressing
+        # Join again only counts as activity.
+        if user_id in self.members:
+            self.setMemberActive(user_id, time.time())
+            return False
+        self.member_reactions[user_id] = {message_id: ()}
+        self.setMemberActive(user_id, time.time())
+        self.last_activity = time.time()
+        self.changed()
+        return True
+
+    def leaveMember(self, user_id):
+        # Button mode. Returns True if the user left the lobby.
+        if user_id not in self.members: return False
+        self.removeMember(user_id)
+        return True
+
+    def removeReaction(self, message_id, user_id, emoji):
+        # Returns True if the user left the lobby. A user stays a member as
+        # long as any of their reactions remain on any of the clones.
+        user_reactions = self.member_reactions.get(user_id)
+        if user_reactions == None or str(emoji) not in user_reactions.get(message_id, ()):
+            self.dropLeftReaction(message_id, user_id, emoji)
+            return False
+        emojis = tuple(user_emoji for user_emoji in user_reactions[message_id] if user_emoji != str(emoji))
+        if len(emojis) > 0: user_reactions[message_id] = emojis
+        else: del user_reactions[message_id]
+        if len(user_reactions) > 0: return False
+        del self.member_reactions[user_id]
+        if user_id not in self.members: return False
+        self.removeMember(user_id)
+        return True
+
+    def dropLeftReaction(self, message_id, user_id, emoji):
+        message_left = self.left_reactions.get(message_id)
+        if message_left == None or user_id not in message_left.get(str(emoji), ()): return
+        message_left[str(emoji)].discard(user_id)
+        if len(message_left[str(emoji)]) == 0: del message_left[str(emoji)]
+        if len(message_left) == 0: del self.left_reactions[message_id]
 
+    def removeMember(self, user_id):
+        self.member_reactions.pop(user_id, None)
+        if self.members.pop(user_id, None) != None:
+            self.changed()
+            if self.member_index != None: self.member_index.memberLeft(self, user_id)
+        self.member_expiry.cancel(user_id)
+        self.last_activity = time.time()
+
+    def removeMessage(self, message_id):
+        # Returns True if members left because all their reactions were on
+        # the removed message.
+        self.forgetMessage(message_id)
+        return self.clearMessageReactions(message_id)
+
+    def forgetMessage(self, message_id):
+        channel_id = self.messages.pop(message_id, None)
+        self.message_content.pop(message_id, None)
+        self.left_reactions.pop(message_id, None)
+        if channel_id not in self.messages.values(): self.channel_guilds.pop(channel_id, None)
+
+    def clearMessageReactions(self, message_id, emoji=None):
+        # Drops the reactions on a message, only those with emoji if given.
+        # Returns True if members left because they had no other reactions.
+        if emoji == None: self.left_reactions.pop(message_id, None)
+        else:
+            self.left_reactions.get(message_id, {}).pop(str(emoji), None)
+            if self.left_reactions.get(message_id) == {}: del self.left_reactions[message_id]
+        members_left = False
+        for user_id in list(self.member_reactions):
+            user_reactions = self.member_reactions[user_id]
+            if message_id not in user_reactions: continue
+            emojis = () if emoji == None else tuple(
+                user_emoji for user_emoji in user_reactions[message_id] if user_emoji != str(emoji))
+            if len(emojis) > 0:
+                user_reactions[message_id] = emojis
+                continue
+            del user_reactions[message_id]
+            if len(user_reactions) == 0:
+                self.removeMember(user_id)
+                members_left = True
+        return members_left
+
+    def reactionsByMessage(self, user_ids=None):
+        # {message_id: {emoji: set of user_ids}} of the given users, all
+        # members if None.
+        reactions = {}
+        for user_id in self.member_reactions if user_ids == None else user_ids:
+            for message_id, emojis in self.member_reactions.get(user_id, {}).items():
+                message_reactions = reactions.setdefault(message_id, {})
+                for emoji in emojis: message_reactions.setdefault(emoji, set()).add(user_id)
+        return reactions
+
+    @metrics.timed('lobby_operation_seconds', operation='clearReactions')
+    async def clearReactions(self, user_ids=None, restore=True, priority=PRIORITY_RENDER):
+        # Removes the given users, all members if None, and their reactions
+        # on the clones. Members are removed right away so they are not
+        # removed again before the reaction events arrive. restore adds the
+        # bot's reaction back if it had to be cleared. Returns the number of
+        # requests made.
+        known = self.reactionsByMessage()
+        removals = self.reactionsByMessage(user_ids)
+        for user_id in list(self.member_reactions if user_ids == None else user_ids):
+            self.removeMember(user_id)
+        if self.mode == MODE_BUTTONS: return 0
+        calls, errors, left = await reactions.clearReactions(self, known, removals, priority, restore)
+        reportErrors(f'Lobby {self.hash} clearReactions', errors, calls)
+        # Without Manage Messages the reactions stay, they are not taken as
+        # joins when the lobby is reconciled.
+        for message_id, message_left in left.items():
+            for emoji, user_ids in message_left.items():
+                self.left_reactions.setdefault(message_id, {}).setdefault(emoji, set()).update(user_ids)
+        return calls
+
+    @metrics.timed('lobby_operation_seconds', operation='updateMemberTimeouts')
     async def updateMemberTimeouts(self):
-        if self.user_timeout < 0: return
-        fetched_messages = False
-        for user_id in self.members:
-            if time.time() - self.members_last_active[user_id] > self.user_timeout:
-                if not fetched_messages: await self.fetchMessages()
-
-                # Clear reactions.
-                for message in self.messages.values():
-                    for reaction in message.reactions:
-                        try:
-                            await message.remove_reaction(reaction, self.members[user_id])
-                        except: pass
+        # Returns True if any members were removed.
+        if self.user_timeout < 0: return False
+        timed_out = self.member_expiry.popDue(time.time() - self.user_timeout)
+        if len(timed_out) == 0: return False
+        await self.clearReactions(timed_out)
+        return True
     
-    async def updateMessages(self):
+    def removeUserReaction(self, message_id, channel_id, emoji, user_id, priority):
+        return self.messageRequest(message_id, channel_id, priority,
+            lambda message: message.remove_reaction(emoji, discord.Object(user_id)), op='remove_reaction')
+
+    def submitEdit(self, channel, message_id, content, priority, components=None):
+        # Queues an edit of the clone to content. Returns the future of the
+        # request, None if the edit would not change the clone. Edits of the
+        # same message supersede each other while queued, the queued one
+        # sends the content last submitted for the clone. components replace
+        # the buttons of the message if given, they need the raw API request.
+        if self.message_content.get(message_id) == content:
+            metrics.increment('edits_skipped_total')
+            return None
+        self.message_content[message_id] = content
+        return dispatcher.submit(channel.id, priority, functools.partial(self.sendEdit, channel, message_id, components),
+            ('edit', message_id), 'edit')
+
+    async def sendEdit(self, channel, message_id, components):
+        # Sends the content of the clone at the time the request is sent. The
+        # content is forgotten if the edit fails.
+        content = self.message_content.get(message_id)
+        if content == None: return
+        try:
+            if components == None: return await channel.get_partial_message(message_id).edit(content=content)
+            return await interactions.editMessage(self.bot, channel.id, message_id, content, components)
+        except:
+            if self.message_content.get(message_id) == content: del self.message_content[message_id]
+            raise
+
+    async def editMessages(self, content, priority, components=None):
+        # Edits every clone to content. The edits are queued at once and
+        # waited for together, the dispatcher limits the requests in flight
+        # and a clone in a busy channel does not hold up the others. Returns
+        # the errors by message_id.
+        channels, channel_errors = await self.getChannels(set(self.messages.values()), priority)
+        errors = {message_id: channel_errors[channel_id]
+            for message_id, channel_id in self.messages.items() if channel_id in channel_errors}
+        futures = {}
+        for message_id, channel_id in self.messages.items():
+            if channel_id not in channels: continue
+            future = self.submitEdit(channels[channel_id], message_id, content, priority, components)
+            if future != None: futures[message_id] = future
+        _, request_errors = await waitRequests(futures)
+        errors.update(request_errors)
+        return errors
+
+    @metrics.timed('lobby_operation_seconds', operation='updateMessages')
+    async def updateMessages(self, priority=PRIORITY_RENDER):
         if self.finalized: return
-        lobby_string = self.getLobbyString()
-        for message in self.messages.values():
-            try: await message.edit(content=lobby_string)
-            except: pass
+        errors = await self.editMessages(self.getLobbyString(), priority)
+        reportErrors(f'Lobby {self.hash} updateMessages', errors, len(self.messages))
 
+    def scheduleUpdate(self):
+        # Coalesce message edits. All changes made within RENDER_DELAY seconds
+        # are sent to the clones as a single edit with the latest state.
+        if self.render_task != None: return
+        self.render_task = asyncio.get_event_loop().create_task(self.delayedUpdate())
+
+    async def delayedUpdate(self):
+        try: await asyncio.sleep(admission.renderDelay(RENDER_DELAY))
+        finally: self.render_task = None
+        await self.updateMessages()
+
+    def cancelUpdate(self):
+        if self.render_task == None: return
+        self.render_task.cancel()
+        self.render_task = None
+
+    @metrics.timed('lobby_operation_seconds', operation='updateLobby')
     async def updateLobby(self):
         if self.finalized: return
 
-        await self.fetchMessages()
-        await self.fetchMembers()
+        messages = await self.fetchMessages()
+        # Button presses are not kept by Discord, the members are only known
+        # here.
+        if self.mode == MODE_REACTIONS: await self.fetchMembers(messages)
         await self.updateMessages()
 
     def isFull(self):
         return len(self.members) >= self.size
 
+    @metrics.timed('lobby_operation_seconds', operation='notifyMembers')
     async def notifyMembers(self):
-        notification_messages = {}
-        for message in self.messages.values():
-            # Get users who reacted to each message
-            users = {}
-            try:
-                for reaction in message.reactions:
-                    async for user in reaction.users():
-                        if user.id == BOT_ID: continue
-                        users[user.id] = user
-                # Send a message in the specified channel
-                content = self.getNotificationString(users)
-            
-                noti_message = await message.channel.send(content)
-                notification_messages[noti_message.id] = noti_message
-            except: pass
-        return notification_messages
+        # Every member is mentioned once, in the channel of the clone they
+        # joined from. Built from member_reactions, so no requests are
+        # needed before sending. Returns the sent notifications as
+        # message_id -> channel_id.
+        message_members = {}
+        for user_id, user_reactions in self.member_reactions.items():
+            joined_message_id = next((message_id for message_id in user_reactions if message_id in self.messages), None)
+            if joined_message_id != None: message_members.setdefault(joined_message_id, []).append(user_id)
+        # Channels are resolved first so the chunks of a clone are submitted
+        # in order, the dispatcher keeps that order within a channel.
+        channel_ids = set(self.messages.values())
+        channels, errors = await self.getChannels(channel_ids, PRIORITY_NOTIFY)
+        reportErrors(f'Lobby {self.hash} notifyMembers getChannel', errors, len(channel_ids))
+        notifications = {}
+        for message_id, channel_id in self.messages.items():
+            if channel_id not in channels: continue
+            channel = channels[channel_id]
+            for i, content in enumerate(self.getNotificationStrings(message_members.get(message_id, []))):
+                notifications[(message_id, i)] = dispatcher.submit(channel_id, PRIORITY_NOTIFY,
+                    functools.partial(channel.send, content), op='send')
 
+        sent, errors = await waitRequests(notifications)
+        reportErrors(f'Lobby {self.hash} notifyMembers', errors, len(notifications))
+        return {message.id: message.channel.id for message in sent.values()}
+
+    @metrics.timed('lobby_operation_seconds', operation='finalizeLobby')
     async def finalizeLobby(self, notify=True, reason='Lobby filled.'):
         if self.finalized: return
         self.finalized = True
+        self.cancelUpdate()
         if notify:
             await self.notifyMembers()
-        for message in self.messages.values():
-            try: await message.edit(content=f'~~{message.content}~~\n{reason}')
-            except: pass
+        lobby_string = self.getLobbyString()
+        # The buttons are removed with the final edit.
+        components = [] if self.mode == MODE_BUTTONS else None
+        errors = await self.editMessages(f'~~{lobby_string}~~\n{reason}', PRIORITY_NOTIFY, components)
+        reportErrors(f'Lobby {self.hash} finalizeLobby', errors, len(self.messages))
+        if reason != 'Lobby filled.':
+            calls = await self.clearReactions(restore=False)
+            print(f'Lobby {self.hash} closed, cleared reactions with {calls} requests')
+
+    async def updateFromInteraction(self, interaction):
+        # Answers a button press with the edit of the pressed clone, the
+        # other clones are rendered as usual.
+        content = self.getLobbyString()
+        self.message_content[interaction.message_id] = content
+        try: await interaction.respond(self.bot, interactions.UPDATE_MESSAGE, {'content': content})
+        except:
+            if self.message_content.get(interaction.message_id) == content: del self.message_content[interaction.message_id]
+            raise
 
     async def postMessage(self, ctx):
         try:
-            message = await ctx.send(self.getLobbyString(False))
-            await message.add_reaction('✅')
-            self.messages[message.id] = message
+            content = self.getLobbyString(False)
+            if self.mode == MODE_BUTTONS:
+                message_id = await self.request(ctx.channel.id, PRIORITY_NOTIFY,
+                    lambda: interactions.sendMessage(self.bot, ctx.channel.id, content), op='send')
+                message = ctx.channel.get_partial_message(message_id)
+            else:
+                message = await self.request(ctx.channel.id, PRIORITY_NOTIFY, lambda: ctx.send(content), op='send')
+                await self.request(ctx.channel.id, PRIORITY_NOTIFY, lambda: message.add_reaction('✅'), op='add_reaction')
+            self.messages[message.id] = message.channel.id
+            self.message_content[message.id] = content
+            if ctx.guild != None: self.channel_guilds[message.channel.id] = ctx.guild.id
         except:
             return None
         return message
 
 class PermanentLobby(Lobby):
+    __slots__ = ('notification_messages', 'type', 'notification_post_time')
+    title = 'Permanent lobby'
+
     def __init__(self, size, name, author_id, lobby_timeout, user_timeout, bot):
         super(PermanentLobby,self).__init__(size, name, author_id, lobby_timeout, user_timeout, bot)
-        self.notification_messages = {}
+        self.notification_messages = {} # message_id -> channel_id
         self.type = 'PermanentLobby'
         self.notification_post_time = -1
     
     def getSaveData(self):
         data = Lobby.getSaveData(self)
-        data['notifications'] = [[message.id, message.channel.id] for message in self.notification_messages.values()]
+        data['notifications'] = [[message_id, channel_id] for message_id, channel_id in self.notification_messages.items()]
         data['type'] = 'PermanentLobby'
         return data
     
-    async def loadData(self, data):
-        await Lobby.loadData(self, data)
-        notification_messages = {}
-        for [message_id, channel_id] in data['notifications']:
-            try:
-                channel = await self.bot.fetch_channel(channel_id)
-                message = await channel.fetch_message(message_id)
-                notification_messages[message_id] = message
-            except: pass
-        self.notification_messages = notification_messages
+    def loadData(self, data):
+        Lobby.loadData(self, data)
+        self.notification_messages = {message_id: channel_id for [message_id, channel_id] in data['notifications']}
 
+    @metrics.timed('lobby_operation_seconds', operation='purgeNotifications')
     async def purgeNotifications(self):
-        for message in self.notification_messages.values():
-            try: await message.delete()
-            except: pass
+        _, errors = await fanOut(
+            lambda message_ref: self.messageRequest(*message_ref, PRIORITY_RENDER,
+                lambda message: message.delete(), op='delete'),
+            messageRefs(self.notification_messages))
+        reportErrors(f'Lobby {self.hash} purgeNotifications', errors, len(self.notification_messages))
         self.notification_messages = {}
 
+    @metrics.timed('lobby_operation_seconds', operation='resetLobby')
     async def resetLobby(self):
-        # Clear reactions.
-        for message in self.messages.values():
-            for reaction in message.reactions:
-                try:
-                    async for user in reaction.users():
-                        if user.id == BOT_ID: continue
-                        try: await message.remove_reaction(reaction, user)
-                        except: pass
-                except: pass
-
-        # Clear members.
-        self.members = {}
+        # Clear members and reactions. Reactions added while the clear is
+        # queued are dropped again by the clear events.
+        calls = await self.clearReactions()
+        print(f'Lobby {self.hash} reset, cleared reactions with {calls} requests')
 
         # Reset messages.
-        lobby_string = self.getLobbyString()
-        for message in self.messages.values():
-            try: await message.edit(content=lobby_string)
-            except: pass
+        await self.updateMessages()
 
+    @metrics.timed('lobby_operation_seconds', operation='finalizeLobby')
     async def finalizeLobby(self, notify=True, reason='Lobby filled.'):
+        self.cancelUpdate()
         if notify:
             await self.purgeNotifications()
             self.notification_messages = await self.notifyMembers()
@@ -258,20 +647,3 @@ class PermanentLobby(Lobby):
             await self.resetLobby()
         else:
             await Lobby.finalizeLobby(self, False, reason)
-
-    def getLobbyString(self, add_mentions=True):
-        mention_str = '\n'.join([member.mention for member in self.members.values()])
-        if mention_str == '': mention_str = '...'
-        if not add_mentions: mention_str = '...'
-        lobby_timeout_str = f'Lobby timer: `{self.timeRemaining()} min`.\n' if self.timeout>0 else ''
-        reac_timeout_str = f'Reaction timeout: `{math.floor(self.user_timeout/60)} min`.\n' if self.user_timeout>0 else ''
-        msg = (
-            f'__**Permanent lobby{self.name}**__\n'
-            f'Mirror this lobby with: `!clonelobby {self.hash}`\n'
-            f'React to message to join lobby. Once `{self.size}` members are reached all members will be pinged.\n'
-            f'{lobby_timeout_str}'
-            f'{reac_timeout_str}'
-            f'**Members {len(self.members)}/{self.size}:**\n'
-            f'{mention_str}\n'
-        )
-        return msg
\ No newline at end of file
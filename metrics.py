@@ -0,0 +1,128 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+
+# Counters, gauges and histograms kept in memory and rendered in the
+# Prometheus text format. Metrics are keyed by name and a sorted tuple of
+# label pairs.
+
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+counters = {}
+gauges = {}
+gauge_callbacks = {}
+histograms = {} # key -> [bucket counts, sum, count]
+
+# Innermost timed() scope, used to attribute Discord requests to the code
+# that made them.
+current_source = contextvars.ContextVar('metrics_source', default='other')
+
+def key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def increment(name, value=1, **labels):
+    k = key(name, labels)
+    counters[k] = counters.get(k, 0) + value
+
+def setGauge(name, value, **labels):
+    gauges[key(name, labels)] = value
+
+def registerGauge(name, callback):
+    # callback() returns the value or a list of (labels, value), evaluated
+    # when metrics are rendered.
+    gauge_callbacks[name] = callback
+
+def observe(name, value, **labels):
+    k = key(name, labels)
+    if k not in histograms: histograms[k] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+    histogram = histograms[k]
+    histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+def timed(name, **labels):
+    # Decorator for coroutine functions, observes the duration of every call
+    # in the {name} histogram. Keeps the signature for discord.py converters.
+    source = '.'.join(str(value) for value in labels.values())
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_source.set(source)
+            start = time.perf_counter()
+            try: return await func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+                current_source.reset(token)
+        return wrapper
+    return decorator
+
+def quantile(name, q, **labels):
+    # Upper bound of the bucket containing the q quantile.
+    histogram = histograms.get(key(name, labels))
+    if histogram == None or histogram[2] == 0: return None
+    target = q * histogram[2]
+    seen = 0
+    for i, count in enumerate(histogram[0]):
+        seen += count
+        if seen >= target: return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+    return float('inf')
+
+def formatLabels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0: return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def collectGauges():
+    values = dict(gauges)
+    for name, callback in gauge_callbacks.items():
+        try: result = callback()
+        except Exception: continue
+        if isinstance(result, list):
+            for labels, value in result: values[key(name, labels)] = value
+        else: values[key(name, {})] = result
+    return values
+
+def render():
+    lines = []
+    for kind, values in [('counter', counters), ('gauge', collectGauges())]:
+        typed = set()
+        for (name, labels), value in sorted(values.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} {kind}')
+                typed.add(name)
+            lines.append(f'{name}{formatLabels(labels)} {value}')
+    typed = set()
+    for (name, labels), [bucket_counts, total, count] in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ['+Inf'], bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{formatLabels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_sum{formatLabels(labels)} {total}')
+        lines.append(f'{name}_count{formatLabels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+async def handleRequest(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''): pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write((
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n').encode() + body)
+        await writer.drain()
+    except Exception: pass
+    finally: writer.close()
+
+async def startServer(host, port):
+    # Serves GET /metrics in the Prometheus text format.
+    return await asyncio.start_server(handleRequest, host, port)
@@ -0,0 +1,93 @@
+import os
+import io
+import sys
+import time
+import asyncio
+import cProfile
+import pstats
+import threading
+import traceback
+
+import metrics
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', '.') # Directory !profile writes its stats files to
+BLOCK_THRESHOLD = float(os.getenv('BLOCK_THRESHOLD', 0.25)) # Seconds the event loop may block before its stack is logged, 0 to disable
+MAX_PROFILE_SECONDS = 300
+SUMMARY_LINES = 15
+
+# Profiles and lag reports for the event loop thread. Everything the bot
+# does runs on that thread, so a profile of it covers every coroutine. A
+# coroutine returns to the profiler at each await and is called again when
+# it resumes, so its time is the time it held the loop, not the time it
+# waited.
+
+active_profile = None
+
+def profiling():
+    return active_profile != None
+
+async def profileLoop(seconds):
+    # Profiles the event loop for seconds and writes the stats to
+    # PROFILE_DIR. Returns the path and the functions that held the loop
+    # longest.
+    global active_profile
+    assert active_profile == None, 'A profile is already running.'
+    active_profile = cProfile.Profile()
+    active_profile.enable()
+    try: await asyncio.sleep(seconds)
+    finally:
+        active_profile.disable()
+        profile, active_profile = active_profile, None
+
+    path = os.path.join(PROFILE_DIR, f'profile-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+    profile.dump_stats(path)
+    summary = io.StringIO()
+    stats = pstats.Stats(profile, stream=summary)
+    stats.strip_dirs().sort_stats('tottime').print_stats(SUMMARY_LINES)
+    # Only the table, without the header pstats prints above it.
+    table = summary.getvalue()
+    return path, table[table.find('   ncalls'):].rstrip()
+
+class LoopWatchdog(threading.Thread):
+    # Thread that logs where the event loop is stuck. A task on the loop
+    # updates a heartbeat, when the heartbeat is older than the threshold
+    # the loop is blocked and the stack of the loop thread and the running
+    # task are printed, once per block.
+
+    def __init__(self, loop, threshold):
+        super(LoopWatchdog, self).__init__(name='loop-watchdog', daemon=True)
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+
+    async def beat(self):
+        self.loop_thread = threading.get_ident()
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def run(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or heartbeat == reported or self.loop_thread == None: continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread)
+            task = asyncio.current_task(self.loop)
+            name = 'no task' if task == None else f'task {task.get_name()} ({task.get_coro().__qualname__})'
+            stack = traceback.extract_stack(frame) if frame != None else []
+            # Frames of the event loop itself are the same in every report.
+            callback = [i for i, entry in enumerate(stack) if entry.name == '_run' and 'asyncio' in entry.filename]
+            if len(callback) > 0: stack = stack[callback[-1] + 1:]
+            print(f'Event loop blocked for at least {blocked:.2f}s in {name}:\n{"".join(traceback.format_list(stack))}', end='')
+            self.loop.call_soon_threadsafe(metrics.increment, 'loop_blocked_total')
+
+def startWatchdog(loop):
+    if BLOCK_THRESHOLD <= 0: return
+    watchdog = LoopWatchdog(loop, BLOCK_THRESHOLD)
+    loop.create_task(watchdog.beat())
+    watchdog.start()
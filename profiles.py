@@ -0,0 +1,29 @@
+import os
+import discord
+
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', 0)) # Messages cached by discord.py in the minimal profile, 0 for none
+
+# Options for the discord.py client. Lobbies are driven by raw events and
+# their own state, the only cached Discord objects they read are channels
+# and the bot's own member and roles for permission checks.
+#
+# 'minimal' - only the intents the bot uses, no message cache beyond
+#     MAX_MESSAGES, no cached members besides the bot and no member
+#     chunking.
+# 'default' - discord.py's defaults.
+
+def clientOptions(profile):
+    if profile == 'default': return {}
+    assert profile == 'minimal', f'Unknown client profile {profile}'
+    intents = discord.Intents.none()
+    intents.guilds = True # Channels and roles
+    intents.guild_messages = True # Commands and message deletes
+    intents.dm_messages = True # Commands in direct messages
+    intents.guild_reactions = True # Raw reaction events
+    intents.dm_reactions = True # Raw reaction events of lobbies in direct messages
+    return {
+        'intents': intents,
+        'max_messages': MAX_MESSAGES if MAX_MESSAGES > 0 else None,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+    }
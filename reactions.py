@@ -0,0 +1,98 @@
+import metrics
+from fanout import fanOut
+
+LOBBY_EMOJI = '✅' # Added by the bot to every lobby message
+
+# Removes reactions from lobby messages with as few requests as possible.
+# In channels where the bot has Manage Messages, a message whose reactions
+# are all being removed is cleared with one clear_reactions and an emoji
+# whose users are all being removed with one clear_reaction. The bot's ✅
+# is added back afterwards when it was cleared. Everything else is removed
+# with one remove_reaction per user and emoji, submitted together so the
+# dispatcher sends them back to back. Removing another user's reaction
+# needs Manage Messages too, so nothing is sent to channels where the bot
+# is known to lack it. When the permission can not be checked the single
+# removals are tried.
+
+def canManageMessages(bot, channel_id):
+    # None if unknown, the channel or the bot's member is not cached.
+    channel = bot.get_channel(channel_id)
+    guild = getattr(channel, 'guild', None)
+    if guild == None or guild.me == None: return None
+    return channel.permissions_for(guild.me).manage_messages
+
+def planMessage(known, removals, bulk, restore):
+    # known and removals are {emoji: set of user_ids} for one message: all
+    # reactions the lobby knows of and the ones to remove. Returns the bulk
+    # requests as a list of (op, emoji), sent in order, and the single
+    # removals as a list of (emoji, user_id). bulk is the result of
+    # canManageMessages.
+    singles = [(emoji, user_id) for emoji, user_ids in removals.items() for user_id in user_ids]
+    if bulk == False:
+        metrics.increment('reaction_clear_skipped_total', len(singles))
+        return [], []
+    if bulk == None: return [], singles
+
+    restore_cost = 1 if restore else 0
+    clears_all = all(user_ids <= removals.get(emoji, set()) for emoji, user_ids in known.items())
+    if clears_all and len(singles) > 1 + restore_cost:
+        steps = [('clear_reactions', None)]
+        if restore: steps.append(('add_reaction', LOBBY_EMOJI))
+        return steps, []
+
+    steps = []
+    singles = []
+    for emoji, user_ids in removals.items():
+        cost = 1 + restore_cost if emoji == LOBBY_EMOJI else 1
+        if known.get(emoji, set()) <= user_ids and len(user_ids) > cost:
+            steps.append(('clear_reaction', emoji))
+            if emoji == LOBBY_EMOJI and restore: steps.append(('add_reaction', emoji))
+        else:
+            singles.extend((emoji, user_id) for user_id in user_ids)
+    return steps, singles
+
+def bulkRequest(op, emoji):
+    if op == 'clear_reactions': return lambda message: message.clear_reactions()
+    if op == 'clear_reaction': return lambda message: message.clear_reaction(emoji)
+    return lambda message: message.add_reaction(emoji)
+
+async def clearReactions(lobby, known, removals, priority, restore=True):
+    # known and removals are {message_id: {emoji: set of user_ids}}. Returns
+    # the number of requests made, the errors keyed by message id, or by
+    # (message_id, emoji, user_id) for single removals, and the removals that
+    # were skipped or failed, shaped like removals. A failed bulk request
+    # counts all removals of its message as not made.
+    calls = 0
+    errors = {}
+    left = {}
+
+    async def clearMessage(message_id):
+        nonlocal calls
+        channel_id = lobby.messages.get(message_id)
+        if channel_id == None: return
+        bulk = canManageMessages(lobby.bot, channel_id)
+        steps, singles = planMessage(known.get(message_id, {}), removals[message_id], bulk, restore)
+        if bulk == False:
+            left[message_id] = removals[message_id]
+            return
+        try:
+            for op, emoji in steps:
+                calls += 1
+                metrics.increment('reaction_clear_calls_total', method='bulk')
+                await lobby.messageRequest(message_id, channel_id, priority, bulkRequest(op, emoji), op=op)
+        except Exception as e:
+            errors[message_id] = e
+            # Only adding the bot's reaction back comes after the removals.
+            if op != 'add_reaction': left[message_id] = removals[message_id]
+            return
+        calls += len(singles)
+        metrics.increment('reaction_clear_calls_total', len(singles), method='single')
+        _, single_errors = await fanOut(
+            lambda single: lobby.removeUserReaction(message_id, channel_id, *single, priority),
+            {(message_id,) + single: single for single in singles})
+        errors.update(single_errors)
+        for _, emoji, user_id in single_errors:
+            left.setdefault(message_id, {}).setdefault(emoji, set()).add(user_id)
+
+    await fanOut(clearMessage, {message_id: message_id for message_id in removals})
+    return calls, errors, left
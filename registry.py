@@ -0,0 +1,116 @@
+
+class LobbyRegistry():
+    # Lookup tables for all live lobbies. Every mutation is a short
+    # synchronous method, so it runs without interruption on the event loop
+    # and never spans a Discord request. Mutations replace the dicts instead
+    # of changing them in place, so a reference to any of them is a
+    # snapshot that can be iterated across awaits. The exception is
+    # member_lobbies, which changes on every join and leave: only its values
+    # are replaced, look users up in it but do not iterate it across awaits.
+    #
+    # Lobbies of a key are kept as {hash: lobby}, ordered by when they were
+    # added.
+    def __init__(self):
+        self.lobbies = {} # hash -> lobby
+        self.lobby_messages = {} # message_id -> lobby
+        self.lobby_authors = {} # author_id -> {hash: lobby}
+        self.lobby_channels = {} # channel_id -> {hash: lobby} of the lobbies with a clone in the channel
+        self.lobby_guilds = {} # guild_id -> {hash: lobby}
+        self.member_lobbies = {} # user_id -> {hash: lobby} of the lobbies the user joined
+        self.lobby_places = {} # hash -> (channel_ids, guild_ids) the lobby is indexed under
+
+    def add(self, lobby, message_ids):
+        lobbies = dict(self.lobbies)
+        lobbies[lobby.hash] = lobby
+        lobby_messages = dict(self.lobby_messages)
+        for message_id in message_ids:
+            lobby_messages[message_id] = lobby
+        self.lobbies, self.lobby_messages = lobbies, lobby_messages
+        self.lobby_authors = addKey(self.lobby_authors, [lobby.author_id], lobby)
+        self.updatePlaces(lobby)
+        for user_id in lobby.members: self.memberJoined(lobby, user_id)
+
+    def addMessage(self, lobby, message_id):
+        lobby_messages = dict(self.lobby_messages)
+        lobby_messages[message_id] = lobby
+        self.lobby_messages = lobby_messages
+        self.updatePlaces(lobby)
+
+    def removeMessage(self, message_id):
+        if message_id not in self.lobby_messages: return None
+        lobby_messages = dict(self.lobby_messages)
+        lobby = lobby_messages.pop(message_id)
+        self.lobby_messages = lobby_messages
+        self.updatePlaces(lobby, message_id)
+        return lobby
+
+    def remove(self, lobby_hash):
+        if lobby_hash not in self.lobbies: return None
+        lobbies = dict(self.lobbies)
+        lobby = lobbies.pop(lobby_hash)
+        lobby_messages = {message_id: message_lobby for message_id, message_lobby in self.lobby_messages.items()
+            if message_lobby is not lobby}
+        channel_ids, guild_ids = self.lobby_places.get(lobby_hash, ((), ()))
+        for user_id in lobby.members: self.memberLeft(lobby, user_id)
+        self.lobbies, self.lobby_messages = lobbies, lobby_messages
+        self.lobby_authors = removeKey(self.lobby_authors, [lobby.author_id], lobby)
+        self.lobby_channels = removeKey(self.lobby_channels, channel_ids, lobby)
+        self.lobby_guilds = removeKey(self.lobby_guilds, guild_ids, lobby)
+        lobby_places = dict(self.lobby_places)
+        lobby_places.pop(lobby_hash, None)
+        self.lobby_places = lobby_places
+        return lobby
+
+    def updatePlaces(self, lobby, removed_message_id=None):
+        # Reindexes the channels and guilds of the lobby's clones.
+        if self.lobbies.get(lobby.hash) is not lobby: return
+        channel_ids = frozenset(channel_id for message_id, channel_id in lobby.messages.items()
+            if message_id != removed_message_id)
+        guild_ids = frozenset(lobby.channel_guilds[channel_id] for channel_id in channel_ids
+            if channel_id in lobby.channel_guilds)
+        old_channel_ids, old_guild_ids = self.lobby_places.get(lobby.hash, (frozenset(), frozenset()))
+        if (channel_ids, guild_ids) == (old_channel_ids, old_guild_ids): return
+        self.lobby_channels = addKey(removeKey(self.lobby_channels, old_channel_ids - channel_ids, lobby),
+            channel_ids - old_channel_ids, lobby)
+        self.lobby_guilds = addKey(removeKey(self.lobby_guilds, old_guild_ids - guild_ids, lobby),
+            guild_ids - old_guild_ids, lobby)
+        lobby_places = dict(self.lobby_places)
+        lobby_places[lobby.hash] = (channel_ids, guild_ids)
+        self.lobby_places = lobby_places
+
+    # Called by Lobby on every join and leave.
+
+    def memberJoined(self, lobby, user_id):
+        if self.lobbies.get(lobby.hash) is not lobby: return
+        user_lobbies = dict(self.member_lobbies.get(user_id, {}))
+        user_lobbies[lobby.hash] = lobby
+        self.member_lobbies[user_id] = user_lobbies
+
+    def memberLeft(self, lobby, user_id):
+        user_lobbies = self.member_lobbies.get(user_id)
+        if user_lobbies == None or user_lobbies.get(lobby.hash) is not lobby: return
+        user_lobbies = dict(user_lobbies)
+        del user_lobbies[lobby.hash]
+        if len(user_lobbies) > 0: self.member_lobbies[user_id] = user_lobbies
+        else: del self.member_lobbies[user_id]
+
+def addKey(index, keys, lobby):
+    # Copy of a {key: {hash: lobby}} index with the lobby added under keys.
+    if len(keys) == 0: return index
+    index = dict(index)
+    for key in keys:
+        key_lobbies = dict(index.get(key, {}))
+        key_lobbies[lobby.hash] = lobby
+        index[key] = key_lobbies
+    return index
+
+def removeKey(index, keys, lobby):
+    # Copy of a {key: {hash: lobby}} index with the lobby removed from keys.
+    if len(keys) == 0: return index
+    index = dict(index)
+    for key in keys:
+        key_lobbies = dict(index.get(key, {}))
+        if key_lobbies.pop(lobby.hash, None) is None: continue
+        if len(key_lobbies) > 0: index[key] = key_lobbies
+        else: del index[key]
+    return index
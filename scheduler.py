@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import time
+
+class DeadlineHeap():
+    # Min-heap of (deadline, key). Each key has at most one live deadline,
+    # entries that were rescheduled or cancelled are left in the heap and
+    # skipped when they reach the top.
+    __slots__ = ('heap', 'deadlines')
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def schedule(self, key, deadline):
+        if deadline == None:
+            self.cancel(key)
+            return
+        if self.deadlines.get(key) == deadline: return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64: self.compact()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def compact(self):
+        self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def nextDeadline(self):
+        while len(self.heap) > 0:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) == deadline: return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def popDue(self, now):
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) != deadline: continue
+            del self.deadlines[key]
+            due.append(key)
+        return due
+
+class DeadlineScheduler(DeadlineHeap):
+    __slots__ = ('wakeup',)
+
+    def __init__(self):
+        super(DeadlineScheduler, self).__init__()
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, key, deadline):
+        DeadlineHeap.schedule(self, key, deadline)
+        if deadline != None and self.nextDeadline() == deadline: self.wakeup.set()
+
+    async def run(self, callback):
+        # Sleeps until the earliest deadline and runs callback(key) as a task
+        # for every key that is due. Idle keys cost nothing.
+        while True:
+            self.wakeup.clear()
+            for key in self.popDue(time.time()):
+                asyncio.ensure_future(callback(key))
+            deadline = self.nextDeadline()
+            timeout = None if deadline == None else max(0, deadline - time.time())
+            try: await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+
+class Mailbox():
+    # Operations waiting for one lobby, applied by a single worker task. The
+    # worker takes everything queued when it wakes up and hands it to the
+    # handler as one batch. It exits once the mailbox is empty and is
+    # started again by the next post.
+    __slots__ = ('pending', 'worker')
+
+    def __init__(self):
+        self.pending = [] # (op, args, future)
+        self.worker = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def busy(self):
+        return self.worker != None
+
+    def post(self, handler, op, *args):
+        # Returns a future for the result of op. handler(batch) must resolve
+        # the future of every operation in the batch.
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((op, args, future))
+        if self.worker == None: self.worker = asyncio.ensure_future(self.run(handler))
+        return future
+
+    async def run(self, handler):
+        try:
+            while len(self.pending) > 0:
+                batch, self.pending = self.pending, []
+                try: await handler(batch)
+                except Exception as e:
+                    print(f'Mailbox handler failed: {e!r}')
+                    for _, _, future in batch:
+                        if not future.done(): future.set_exception(e)
+        finally: self.worker = None
@@ -0,0 +1,45 @@
+import os
+import discord
+from discord.ext import commands
+
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) # Shards over all processes, 0 to run a single unsharded bot
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip() != ''] # Shards run by this process, all if empty
+FORWARD_INTERVAL = float(os.getenv('FORWARD_INTERVAL', 0.2)) # Seconds between checks for forwarded operations
+
+# Every lobby is owned by the shard of the guild it was created in and only
+# the process running that shard keeps it in memory. Events and commands for
+# clones in guilds of other shards are forwarded to the owner through the
+# shared store, the owner reaches every channel over REST.
+
+def enabled():
+    return SHARD_COUNT > 0
+
+def localShards():
+    if not enabled(): return [0]
+    if len(SHARD_IDS) == 0: return list(range(SHARD_COUNT))
+    return SHARD_IDS
+
+def isLocal(shard):
+    return shard in localShards()
+
+def shardOf(guild_id):
+    # Discord's shard formula, direct messages go to shard 0.
+    if not enabled() or guild_id == None: return 0
+    return (guild_id >> 22) % SHARD_COUNT
+
+def createBot(**options):
+    if not enabled(): return commands.Bot(**options)
+    if len(SHARD_IDS) > 0: options['shard_ids'] = SHARD_IDS
+    return commands.AutoShardedBot(shard_count=SHARD_COUNT, **options)
+
+class ForwardedContext():
+    # Stands in for the Context of a command forwarded from another shard.
+    # The channel is usually not cached here, replies are sent over REST.
+    def __init__(self, channel, message_id, author_id):
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.message = channel.get_partial_message(message_id)
+        self.author = discord.Object(author_id)
+
+    async def send(self, content):
+        return await self.channel.send(content)
@@ -0,0 +1,157 @@
+import os
+import json
+import sqlite3
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+LOBBY_DB = os.getenv('LOBBY_DB', 'lobbies.db') # SQLite file lobbies are saved to
+SAVE_DELAY = float(os.getenv('LOBBY_SAVE_DELAY', 1)) # Seconds to collect changes before writing
+
+class LobbyStore():
+    # Saves lobbies to SQLite in WAL mode, one row per lobby. Changed lobbies
+    # are marked dirty and written together in one transaction on a worker
+    # thread, so the event loop never waits for the disk.
+    #
+    # The database is shared by all shard processes. Each lobby row records
+    # the shard owning it, the messages table maps every clone to its lobby
+    # and the ops table carries operations forwarded to other shards.
+    def __init__(self, path=LOBBY_DB):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS lobbies (hash TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        columns = [column[1] for column in self.db.execute('PRAGMA table_info(lobbies)')]
+        if 'shard' not in columns:
+            self.db.execute('ALTER TABLE lobbies ADD COLUMN shard INTEGER NOT NULL DEFAULT 0')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (message_id INTEGER PRIMARY KEY, hash TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_hash ON messages (hash)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ops (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'shard INTEGER NOT NULL, data TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.commit()
+
+        # One thread, so the connection is never used by two threads at once.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.dirty = {} # hash -> lobby, None if the lobby was removed
+        self.flush_task = None
+        self.write_lock = asyncio.Lock()
+
+    def run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def loadAll(self, shards=None):
+        # Lobbies owned by the given shards, all if None.
+        rows = self.db.execute('SELECT data, shard FROM lobbies')
+        return [json.loads(data) for (data, shard) in rows if shards == None or shard in shards]
+
+    def importJson(self, path):
+        # One time migration from the old lobbies.json dump. The import is
+        # recorded, lobbies closed since then must not come back from the
+        # file. Databases that already have lobbies were migrated before the
+        # import was recorded.
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() != None: return
+        data = {}
+        if os.path.exists(path) and self.db.execute('SELECT COUNT(*) FROM lobbies').fetchone()[0] == 0:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.write([self.row(lobby_data) for lobby_data in data.values()], [])
+            print(f'Imported {len(data)} lobbies from {path}.')
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (str(len(data)),))
+
+    def row(self, lobby_data):
+        message_ids = [message_id for [message_id, channel_id] in lobby_data['messages']]
+        return (lobby_data['hash'], lobby_data.get('shard', 0), json.dumps(lobby_data), message_ids)
+
+    def markDirty(self, lobby):
+        self.dirty[lobby.hash] = lobby
+        self.scheduleFlush()
+
+    def markRemoved(self, lobby_hash):
+        self.dirty[lobby_hash] = None
+        self.scheduleFlush()
+
+    def scheduleFlush(self):
+        if self.flush_task != None: return
+        self.flush_task = asyncio.ensure_future(self.delayedFlush())
+
+    async def delayedFlush(self):
+        try: await asyncio.sleep(SAVE_DELAY)
+        finally: self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.write_lock:
+            dirty, self.dirty = self.dirty, {}
+            if len(dirty) == 0: return
+            # Lobby state is only consistent on the event loop, serialize here
+            # and leave the disk I/O to the worker thread.
+            start = time.perf_counter()
+            rows = []
+            removed = []
+            try:
+                for lobby_hash, lobby in dirty.items():
+                    if lobby == None: removed.append(lobby_hash)
+                    else: rows.append(self.row(lobby.getSaveData()))
+                await self.run(self.write, rows, removed)
+            except Exception as e:
+                # Saved with the next flush. Lobbies marked again meanwhile
+                # keep their newer entry.
+                for lobby_hash, lobby in dirty.items(): self.dirty.setdefault(lobby_hash, lobby)
+                self.scheduleFlush()
+                metrics.increment('persistence_flush_errors_total')
+                print(f'Saving {len(dirty)} lobbies failed: {e!r}')
+                raise
+            metrics.observe('persistence_flush_seconds', time.perf_counter() - start)
+            metrics.increment('persistence_rows_written_total', len(rows))
+            metrics.increment('persistence_rows_deleted_total', len(removed))
+
+    def write(self, rows, removed):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO lobbies (hash, shard, data) VALUES (?, ?, ?)',
+                [(lobby_hash, shard, data) for lobby_hash, shard, data, _ in rows])
+            self.db.executemany('DELETE FROM messages WHERE hash = ?',
+                [(lobby_hash,) for lobby_hash, _, _, _ in rows] + [(lobby_hash,) for lobby_hash in removed])
+            self.db.executemany('INSERT OR REPLACE INTO messages (message_id, hash) VALUES (?, ?)',
+                [(message_id, lobby_hash) for lobby_hash, _, _, message_ids in rows for message_id in message_ids])
+            self.db.executemany('DELETE FROM lobbies WHERE hash = ?', [(lobby_hash,) for lobby_hash in removed])
+
+    # Routing between shards.
+
+    def lobbyShard(self, lobby_hash):
+        # Shard owning the lobby, None if it does not exist.
+        return self.run(self.selectShard, 'SELECT shard FROM lobbies WHERE hash = ?', lobby_hash)
+
+    def messageShard(self, message_id):
+        # Shard owning the lobby of a message, None if it is not a lobby message.
+        return self.run(self.selectShard,
+            'SELECT shard FROM messages JOIN lobbies USING (hash) WHERE message_id = ?', message_id)
+
+    def selectShard(self, query, key):
+        row = self.db.execute(query, (key,)).fetchone()
+        return None if row == None else row[0]
+
+    def forward(self, shard, op):
+        metrics.increment('forwarded_ops_total', op=op['op'])
+        return self.run(self.insertOp, shard, json.dumps(op))
+
+    def insertOp(self, shard, data):
+        with self.db:
+            self.db.execute('INSERT INTO ops (shard, data) VALUES (?, ?)', (shard, data))
+
+    def takeOps(self, shards):
+        # Removes and returns the operations forwarded to the given shards, oldest first.
+        return self.run(self.deleteOps, shards)
+
+    def deleteOps(self, shards):
+        placeholders = ','.join('?' * len(shards))
+        with self.db:
+            rows = self.db.execute(f'SELECT id, data FROM ops WHERE shard IN ({placeholders}) ORDER BY id',
+                shards).fetchall()
+            if len(rows) > 0:
+                self.db.execute(f'DELETE FROM ops WHERE shard IN ({placeholders}) AND id <= ?',
+                    shards + [rows[-1][0]])
+        return [json.loads(data) for _, data in rows]
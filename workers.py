@@ -0,0 +1,51 @@
+import os
+import argparse
+
+from dotenv import load_dotenv
+
+# Writes docker-compose.override.yml with one service per worker process.
+# Compose merges the override into docker-compose.yml, which alone runs a
+# single worker with every shard. The shards of SHARD_COUNT are dealt out
+# over the workers in turn.
+#
+# Usage: python workers.py [--workers N], then docker-compose up -d
+
+load_dotenv()
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0)) # Shards over all processes
+WORKERS = int(os.getenv('WORKERS', SHARD_COUNT)) # Worker processes, one per shard by default
+OVERRIDE_FILE = 'docker-compose.override.yml'
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Write the Compose services of the shard workers.')
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT, help='Shards over all workers.')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Worker processes.')
+    parser.add_argument('--output', default=OVERRIDE_FILE)
+    return parser.parse_args()
+
+def service(index, shard_count, shard_ids):
+    return '\n'.join([
+        f'  lobby-bot-{index}:',
+        '    image: super-lobby-bot',
+        '    restart: unless-stopped',
+        '    env_file: .env',
+        f'    container_name: super-lobby-bot-{index}',
+        '    volumes:',
+        '      - ./data:/data',
+        '    environment:',
+        '      LOBBY_DB: /data/lobbies.db',
+        f'      SHARD_COUNT: {shard_count}',
+        f'      SHARD_IDS: "{",".join(str(shard_id) for shard_id in shard_ids)}"',
+    ])
+
+def main():
+    args = parseArgs()
+    assert args.shards > 0, 'Set SHARD_COUNT in .env or pass --shards.'
+    assert 0 < args.workers <= args.shards, 'Every worker needs at least one shard.'
+    services = [service(i, args.shards, range(i, args.shards, args.workers)) for i in range(args.workers)]
+    with open(args.output, 'w') as f:
+        f.write(f'# Written by workers.py for {args.shards} shards over {args.workers} workers.\n')
+        f.write('version: "3"\n\nservices:\n' + '\n\n'.join(services) + '\n')
+    print(f'Wrote {args.workers} workers to {args.output}.')
+
+if __name__ == '__main__':
+    main()